@@ -1,7 +1,9 @@
+import logging
 import os
 import shlex
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 
 class ApplyAudioException(Exception):
@@ -31,3 +33,72 @@ def apply_audio_to(cropped_video_file, source_audio_file, audio_start, audio_end
 
     os.remove(audio_file)
     shutil.move(video_with_audio_file, cropped_video_file)
+
+
+def apply_audio_batch(fragments, source_audio_file, workers=4):
+    """Joins audio to fragments given as (cropped_video_file, audio_start, audio_end),
+    same as apply_audio_to for each of them, but the source audio is read once
+    and all fragments are muxed by one more ffmpeg run. If that fails fragments
+    are joined one by one by a pool of workers. Returns a list with None or
+    ApplyAudioException for each fragment."""
+    try:
+        _apply_audio_batch(fragments, source_audio_file)
+        return [None] * len(fragments)
+    except ApplyAudioException as e:
+        logging.warning("Batch join with audio error: %s, join %s fragments one by one" % (str(e), len(fragments)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(apply_audio_to, cropped_video_file, source_audio_file, audio_start, audio_end)
+            for cropped_video_file, audio_start, audio_end in fragments
+        ]
+    errors = []
+    for future in futures:
+        try:
+            future.result()
+            errors.append(None)
+        except ApplyAudioException as e:
+            errors.append(e)
+    return errors
+
+
+def _apply_audio_batch(fragments, source_audio_file):
+    video_exts = [os.path.splitext(cropped_video_file) for cropped_video_file, _, _ in fragments]
+    audio_files = [video_ext[0] + ".aac" for video_ext in video_exts]
+    video_with_audio_files = [video_ext[0] + ".audio" + video_ext[1] for video_ext in video_exts]
+    for f in audio_files + video_with_audio_files:
+        if os.path.exists(f):
+            os.remove(f)
+
+    try:
+        # get all cropped audio in one pass over source audio
+        outputs = ' '.join(
+            '-map 0:a -ss %s -to %s -acodec copy "%s"' % (audio_start, audio_end, audio_file)
+            for (_, audio_start, audio_end), audio_file in zip(fragments, audio_files)
+        )
+        cmd = 'ffmpeg -y -i "%s" %s' % (source_audio_file, outputs)
+        code = subprocess.call(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if code != 0:
+            raise ApplyAudioException("Failed run %s: exit code %s" % (cmd, code))
+
+        # join each cropped audio with its video
+        inputs = ' '.join(
+            '-i "%s" -i "%s"' % (cropped_video_file, audio_file)
+            for (cropped_video_file, _, _), audio_file in zip(fragments, audio_files)
+        )
+        outputs = ' '.join(
+            '-map %d:v -map %d:a -c:v copy -c:a aac "%s"' % (i * 2, i * 2 + 1, video_with_audio_file)
+            for i, video_with_audio_file in enumerate(video_with_audio_files)
+        )
+        cmd = 'ffmpeg %s %s' % (inputs, outputs)
+        code = subprocess.call(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if code != 0:
+            raise ApplyAudioException("Failed run %s: exit code %s" % (cmd, code))
+
+        for (cropped_video_file, _, _), video_with_audio_file in zip(fragments, video_with_audio_files):
+            shutil.move(video_with_audio_file, cropped_video_file)
+
+    finally:
+        for f in audio_files + video_with_audio_files:
+            if os.path.exists(f):
+                os.remove(f)
@@ -1,36 +1,89 @@
 import typing
-from skimage.metrics import structural_similarity
 
 import detect
-from util import image_resize
+import scene
+import track
 
 
 class CheckFrameException(Exception):
     pass
 
 
+class SceneChangeException(CheckFrameException):
+    pass
+
+
 _face_detect_threshold: typing.Optional[float] = None
 _change_scene_threshold: typing.Optional[float] = None
+_scene_detector: typing.Optional[scene.SceneChangeDetector] = None
+_face_tracker: typing.Optional[track.FaceTracker] = None
 
 
-def initialize(models_dir="./models", face_detect_threshold=.5, change_scene_threshold=.5):
-    global _face_detect_driver, _change_scene_threshold, _face_detect_threshold
-    detect.init_detector(models_dir)
+def initialize(models_dir="./models", face_detect_threshold=.5, change_scene_threshold=.5,
+               change_scene_metric=scene.SSIM, track_full_every=1, track_iou_threshold=.5,
+               face_detector_kwargs=None):
+    global _face_detect_driver, _change_scene_threshold, _face_detect_threshold, _scene_detector, _face_tracker
+    detect.init_detector(models_dir, face_detector_kwargs=face_detector_kwargs)
     _change_scene_threshold = change_scene_threshold
     _face_detect_threshold = face_detect_threshold
+    _scene_detector = scene.SceneChangeDetector(change_scene_metric)
+    if track_full_every > 1:
+        _face_tracker = track.FaceTracker(full_every=track_full_every, iou_threshold=track_iou_threshold)
 
 
 def is_correct(frame, previous=None):
-    if _change_scene_threshold is not None and previous is not None:
-        score, _ = structural_similarity(_small_img(frame), _small_img(previous), full=True, multichannel=True)
-        if 1 - score > _change_scene_threshold:
-            raise CheckFrameException("large difference with previous frame, probably another scene")
+    error = check_batch([frame], previous)[0]
+    if error is not None:
+        raise error
+
+
+def check_batch(frames, previous=None, indices=None, previous_index=None, track=True):
+    """Checks frames as ``is_correct`` does, each against the one before it.
+    The face detector runs once for all frames that passed the scene check.
+    indices and previous_index are frame indices to cache scene checks by.
+    With track the face tracker (if enabled) is used and advanced, it runs
+    the full detector unless previous_index is the frame it tracked last;
+    checks out of order (e.g. bisecting) pass track=False.
+    Returns a list with None for correct frames and CheckFrameException
+    for incorrect ones, SceneChangeException for ones of another scene."""
+    errors = [None] * len(frames)
+    resized = [detect.resize_for_detector(frame) for frame in frames]
+    if indices is None:
+        indices = [None] * len(frames)
+
+    tracker = _face_tracker if track else None
+    if tracker is not None and (previous_index is None or previous_index != tracker.last_index):
+        # the tracked face is not of the previous frame
+        tracker.reset()
+
+    if _change_scene_threshold is not None:
+        # scenes are compared on the detector inputs, whichever frames come
+        if previous is not None and not _scene_detector.cached(previous_index):
+            previous = detect.resize_for_detector(previous)
+        for i, image in enumerate(resized):
+            difference = _scene_detector.difference(image, previous, indices[i], previous_index)
+            if difference is not None and difference > _change_scene_threshold:
+                errors[i] = SceneChangeException("large difference with previous frame, probably another scene")
+            previous, previous_index = image, indices[i]
+
+    scene_changed = [error is not None for error in errors]
+    to_detect = [i for i, changed in enumerate(scene_changed) if not changed]
+    if to_detect:
+        images = [resized[i] for i in to_detect]
+        if tracker is not None:
+            fresh = [i > 0 and scene_changed[i - 1] for i in to_detect]
+            faces = tracker.detect_batch(images, threshold=_face_detect_threshold, fresh=fresh)
+        else:
+            faces = detect.detect_faces_batch(images, threshold=_face_detect_threshold, resized=True)
+        for i, frame_faces in zip(to_detect, faces):
+            if len(frame_faces) != 1:
+                errors[i] = CheckFrameException("detected %d faces, expected 1" % len(frame_faces))
 
-    faces = detect.detect_faces(frame, threshold=_face_detect_threshold)
-    if len(faces) != 1:
-        raise CheckFrameException("detected %d faces, expected 1" % len(faces))
+    if tracker is not None:
+        if scene_changed and scene_changed[-1]:
+            tracker.reset()
+        else:
+            tracker.last_index = indices[-1]
 
+    return errors
 
-def _small_img(image, width=100, height=100):
-    resized, _ = image_resize(image, width=width, height=height, contain_proportions=False)
-    return resized
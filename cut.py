@@ -0,0 +1,226 @@
+import logging
+import os
+import shlex
+import subprocess
+import tempfile
+
+
+class CutException(Exception):
+    pass
+
+
+# cut exactly at start/end, ffmpeg copies from the keyframe before start
+COPY = 'copy'
+# move start/end inwards to the closest keyframes, then copy
+KEYFRAME = 'keyframe'
+# copy whole GOPs, re-encode only the partial GOPs at both ends with the
+# source profile and pixel format, as KEYFRAME if they can not be matched
+SMART = 'smart'
+
+MODES = (COPY, KEYFRAME, SMART)
+
+_encoders = {
+    'h264': 'libx264',
+    'hevc': 'libx265',
+    'vp8': 'libvpx',
+    'vp9': 'libvpx-vp9',
+    'av1': 'libaom-av1',
+}
+
+# ffprobe profile names to encoder -profile:v values, re-encoded ends are
+# concatenated with copied GOPs, so their stream parameters must match
+_profiles = {
+    'libx264': {
+        'constrained baseline': 'baseline',
+        'baseline': 'baseline',
+        'main': 'main',
+        'high': 'high',
+        'high 10': 'high10',
+        'high 4:2:2': 'high422',
+        'high 4:4:4 predictive': 'high444',
+    },
+    'libx265': {
+        'main': 'main',
+        'main 10': 'main10',
+        'main still picture': 'mainstillpicture',
+    },
+    'libvpx-vp9': {
+        'profile 0': '0',
+        'profile 1': '1',
+        'profile 2': '2',
+        'profile 3': '3',
+    },
+}
+
+# muxers taking -video_track_timescale
+_timescale_exts = ('.mp4', '.m4v', '.mov')
+
+# half of a frame at 60fps
+_eps = 1. / 120
+
+
+def _run(cmd):
+    try:
+        code = subprocess.call(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise CutException("Failed run %s: %s" % (cmd, e))
+    if code != 0:
+        raise CutException("Failed run %s: exit code %s" % (cmd, code))
+
+
+def _probe(cmd):
+    try:
+        return subprocess.check_output(shlex.split(cmd), stderr=subprocess.PIPE).decode()
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise CutException("Failed run %s: %s" % (cmd, e))
+
+
+def keyframe_times(video_file):
+    """Returns sorted keyframe times of the first video stream in seconds
+    from the stream start. Reads packets only, nothing is decoded."""
+    cmd = 'ffprobe -v error -select_streams v:0 -show_entries packet=pts_time,flags -of csv=p=0 "%s"' % video_file
+    first = None
+    times = []
+    for line in _probe(cmd).splitlines():
+        pts_time, _, flags = line.partition(',')
+        if pts_time in ('', 'N/A'):
+            continue
+        pts_time = float(pts_time)
+        if first is None or pts_time < first:
+            first = pts_time
+        if 'K' in flags:
+            times.append(pts_time)
+    return sorted(t - first for t in times)
+
+
+def video_stream(video_file):
+    """Returns codec_name, profile, level, pix_fmt and time_base of the
+    first video stream as probed strings."""
+    cmd = 'ffprobe -v error -select_streams v:0 -show_entries stream=codec_name,profile,level,pix_fmt,time_base ' \
+          '-of default=noprint_wrappers=1 "%s"' % video_file
+    stream = {}
+    for line in _probe(cmd).splitlines():
+        key, _, value = line.partition('=')
+        stream[key.strip()] = value.strip()
+    return stream
+
+
+def _encode_options(stream, ext):
+    """Returns ffmpeg output options encoding to the parameters of stream,
+    None if they can not be matched."""
+    encoder = _encoders.get(stream.get('codec_name'))
+    profile = _profiles.get(encoder, {}).get(stream.get('profile', '').lower())
+    pix_fmt = stream.get('pix_fmt')
+    if profile is None or pix_fmt in (None, '', 'unknown'):
+        return None
+    options = '-c:v %s -profile:v %s -pix_fmt %s' % (encoder, profile, pix_fmt)
+
+    level = stream.get('level', '')
+    if level.isdigit() and int(level) > 0:
+        if encoder == 'libx264':
+            options += ' -level:v %s' % (int(level) / 10.)
+        elif encoder == 'libx265':
+            options += ' -x265-params level-idc=%s' % (int(level) / 30.)
+    return options + _timescale_option(stream, ext)
+
+
+def _timescale_option(stream, ext):
+    _, _, timescale = stream.get('time_base', '').partition('/')
+    if ext.lower() in _timescale_exts and timescale.isdigit():
+        return ' -video_track_timescale %s' % timescale
+    return ''
+
+
+def snap_to_keyframes(keyframes, start, end):
+    """Returns the first keyframe at or after start and the last one at or
+    before end, None for a missing one."""
+    after = [k for k in keyframes if k >= start - _eps]
+    before = [k for k in keyframes if k <= end + _eps]
+    return (after[0] if after else None), (before[-1] if before else None)
+
+
+def cut_fragment(video_file, output_file, start, end, audio_file=None, mode=COPY, keyframes=None):
+    """Cuts [start, end) seconds of video_file to output_file without decoding
+    frames that can be copied. Audio is taken from audio_file (it may be
+    video_file itself) and encoded to AAC the same way audio.apply_audio_to
+    does. keyframes are keyframe_times(video_file), probed if not given."""
+    if mode not in MODES:
+        raise CutException("Unknown cut mode %s" % mode)
+
+    if os.path.exists(output_file):
+        os.remove(output_file)
+
+    if mode == COPY:
+        _copy(video_file, output_file, start, end, audio_file)
+        return start, end
+
+    if keyframes is None:
+        keyframes = keyframe_times(video_file)
+    key_start, key_end = snap_to_keyframes(keyframes, start, end)
+
+    if mode == KEYFRAME:
+        if key_start is None or key_end is None or key_end - key_start < _eps:
+            raise CutException("No keyframes inside %s-%s sec" % (start, end))
+        _copy(video_file, output_file, key_start, key_end, audio_file)
+        return key_start, key_end
+
+    return _smart_cut(video_file, output_file, start, end, key_start, key_end, audio_file)
+
+
+def _copy(video_file, output_file, start, end, audio_file=None):
+    inputs = '-ss %s -t %s -i "%s"' % (start, end - start, video_file)
+    maps = '-map 0:v:0 -c:v copy'
+    if audio_file:
+        inputs += ' -ss %s -t %s -i "%s"' % (start, end - start, audio_file)
+        maps += ' -map 1:a:0 -c:a aac'
+    _run('ffmpeg -y %s %s -avoid_negative_ts make_zero "%s"' % (inputs, maps, output_file))
+
+
+def _smart_cut(video_file, output_file, start, end, key_start, key_end, audio_file=None):
+    # returns the cut range, keyframe snapped when ends can not be re-encoded
+    name, ext = os.path.splitext(os.path.basename(output_file))
+    stream = video_stream(video_file)
+    if stream.get('codec_name') not in _encoders:
+        raise CutException("No encoder for the video codec of %s" % video_file)
+    encode_options = _encode_options(stream, ext)
+    if encode_options is None:
+        if key_start is None or key_end is None or key_end - key_start < _eps:
+            raise CutException("No keyframes inside %s-%s sec" % (start, end))
+        logging.warning("Can not re-encode %s profile %s %s, cut at keyframes" % (
+            stream.get('codec_name'), stream.get('profile'), stream.get('pix_fmt')))
+        _copy(video_file, output_file, key_start, key_end, audio_file)
+        return key_start, key_end
+    copy_options = '-c:v copy' + _timescale_option(stream, ext)
+
+    if key_start is None or key_end is None or key_end - key_start < _eps:
+        # range is inside one GOP
+        segments = [(start, end, True)]
+    else:
+        segments = []
+        if key_start - start > _eps:
+            segments.append((start, key_start, True))
+        segments.append((key_start, key_end, False))
+        if end - key_end > _eps:
+            segments.append((key_end, end, True))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        parts = []
+        for i, (seg_start, seg_end, encode) in enumerate(segments):
+            part = os.path.join(temp_dir, "%s.%d%s" % (name, i, ext))
+            codec = encode_options if encode else copy_options
+            _run('ffmpeg -y -ss %s -t %s -i "%s" -map 0:v:0 %s -avoid_negative_ts make_zero "%s"' % (
+                seg_start, seg_end - seg_start, video_file, codec, part))
+            parts.append(part)
+
+        concat_list = os.path.join(temp_dir, name + ".txt")
+        with open(concat_list, 'w') as f:
+            for part in parts:
+                f.write("file '%s'\n" % part)
+
+        inputs = '-f concat -safe 0 -i "%s"' % concat_list
+        maps = '-map 0:v:0 %s' % copy_options
+        if audio_file:
+            inputs += ' -ss %s -t %s -i "%s"' % (start, end - start, audio_file)
+            maps += ' -map 1:a:0 -c:a aac'
+        _run('ffmpeg -y %s %s "%s"' % (inputs, maps, output_file))
+    return start, end
@@ -0,0 +1,90 @@
+import functools
+import subprocess
+import tempfile
+
+import numpy as np
+
+
+class DecodeException(Exception):
+    pass
+
+
+def read_scaled(video_file, width, height, first_frame=0, every=1, n_frames=None):
+    """Returns a generator of (frame_idx, frame) of video_file from
+    first_frame, decoded and scaled to width x height BGR by ffmpeg.
+    With every > 1 only frames with frame_idx divisible by it are scaled
+    and piped, others are generated as None. Frames are selected by their
+    index, not by time, so indices do not drift on variable frame rate
+    sources. The generator raises DecodeException after the last frame if
+    ffmpeg failed, or if n_frames is given and the video has another
+    number of frames."""
+    cmd = ['ffmpeg', '-v', 'error', '-i', video_file]
+    conditions = []
+    if first_frame:
+        conditions.append('gte(n\\,{})'.format(first_frame))
+    if every > 1:
+        conditions.append('not(mod(n\\,{}))'.format(every))
+    filters = []
+    if conditions:
+        filters.append('select=' + '*'.join(conditions))
+    filters.append('scale={}:{}:flags=area'.format(width, height))
+    cmd += ['-vf', ','.join(filters)] + _passthrough_args() + ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+
+    # a file does not fill up and block ffmpeg as an unread pipe would
+    stderr = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+    except OSError as e:
+        stderr.close()
+        raise DecodeException("Failed run %s: %s" % (' '.join(cmd), e))
+    return _read_pipe(proc, stderr, ' '.join(cmd), width, height, first_frame, every, n_frames)
+
+
+@functools.lru_cache(maxsize=None)
+def _passthrough_args():
+    # -vsync is deprecated since ffmpeg 5.1 which has -fps_mode instead
+    probe = ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'nullsrc', '-frames:v', '1',
+             '-fps_mode', 'passthrough', '-f', 'null', '-']
+    try:
+        code = subprocess.call(probe, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        code = 1
+    return ['-fps_mode', 'passthrough'] if code == 0 else ['-vsync', '0']
+
+
+def _read_pipe(proc, stderr, cmd, width, height, first_frame, every, n_frames):
+    # raises DecodeException at the end of the output if ffmpeg failed
+    # or piped another number of frames than n_frames has
+    frame_size = width * height * 3
+    frame_idx = first_frame - 1
+    # first frame with index divisible by every
+    next_idx = first_frame + (-first_frame % every)
+    piped = 0
+    try:
+        while True:
+            data = proc.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            while frame_idx + 1 < next_idx:
+                frame_idx += 1
+                yield frame_idx, None
+            frame_idx += 1
+            yield frame_idx, np.frombuffer(data, dtype=np.uint8).reshape((height, width, 3))
+            next_idx += every
+            piped += 1
+        code = proc.wait()
+        if code != 0:
+            stderr.seek(0)
+            message = stderr.read().decode(errors='replace').strip()
+            raise DecodeException("Failed run %s: exit code %s after frame %s: %s" % (cmd, code, frame_idx, message))
+        if n_frames is not None:
+            expected = len(range(first_frame + (-first_frame % every), n_frames, every))
+            if piped != expected:
+                raise DecodeException("Failed run %s: %s frames decoded, %s expected from frame count %s" %
+                                      (cmd, piped, expected, n_frames))
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        stderr.close()
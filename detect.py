@@ -1,5 +1,6 @@
 import logging
 
+import cv2
 import torch
 
 import face_alignment
@@ -8,10 +9,14 @@ from util import image_resize
 
 fa = None
 
+# (width, height) images are resized to for the face detector
+DETECTOR_SIZE = (300, 300)
+
 
 def init_detector(
         models_dir,
         face_detector='sfd',
+        face_detector_kwargs=None,
 ):
     global fa
     if fa:
@@ -23,14 +28,22 @@ def init_detector(
     else:
         device = 'cpu'
         logging.info(f"torch device: CPU")
+    # only the face detector is loaded, FAN is loaded on first landmarks call
     fa = face_alignment.FaceAlignment(
         face_alignment.LandmarksType._2D,
         face_detector=face_detector,
         device=device,
         models_dir=models_dir,
+        face_detector_kwargs=face_detector_kwargs,
     )
 
 
+def set_num_threads(threads):
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+    logging.info(f"torch and OpenCV threads: {threads}")
+
+
 def _check_fa():
     if not fa:
         raise RuntimeError("face alignment not initialized")
@@ -40,13 +53,33 @@ def detect_faces(image, threshold=.5):
 
     _check_fa()
 
-    image_resized, aspects = image_resize(
+    with torch.no_grad():
+        faces = fa.face_detector.detect_from_batch([resize_for_detector(image)], threshold=threshold, bgr=True)[0]
+
+    return faces
+
+
+def resize_for_detector(image, width=DETECTOR_SIZE[0], height=DETECTOR_SIZE[1]):
+    if image.shape[:2] == (height, width):
+        return image
+    image_resized, _ = image_resize(
         image,
-        width=300, height=300,
+        width=width, height=height,
         contain_proportions=False,
     )
+    return image_resized
+
+
+def detect_faces_batch(images, threshold=.5, resized=False):
+    """Detects faces on each of images, resized are already
+    resize_for_detector images. BGR frames are passed to the detector
+    as they are, its input is filled from them in one step."""
+
+    _check_fa()
+
+    images_resized = images if resized else [resize_for_detector(image) for image in images]
 
     with torch.no_grad():
-        faces = fa.face_detector.detect_from_image(image_resized[..., ::-1].copy(), threshold=threshold)
+        faces = fa.face_detector.detect_from_batch(images_resized, threshold=threshold, bgr=True)
 
     return faces
@@ -53,16 +53,20 @@ models_urls = {
 
 
 class FaceAlignment:
+    """Face detector with FAN landmark networks. The landmark networks are
+    loaded on first use, so a FaceAlignment used for face_detector only
+    never loads their weights."""
+
     def __init__(self, landmarks_type, network_size=NetworkSize.LARGE,
                  device='cuda', flip_input=False, face_detector='sfd', verbose=False,
-                 models_dir=None):
+                 models_dir=None, face_detector_kwargs=None):
         self.device = device
         self.flip_input = flip_input
         self.landmarks_type = landmarks_type
         self.verbose = verbose
         self.models_dir = models_dir
 
-        network_size = int(network_size)
+        self.network_size = int(network_size)
 
         if 'cuda' in device:
             torch.backends.cudnn.benchmark = True
@@ -71,35 +75,49 @@ class FaceAlignment:
         face_detector_module = __import__('face_alignment.detection.' + face_detector,
                                           globals(), locals(), [face_detector], 0)
         self.face_detector = face_detector_module.FaceDetector(
-            device=device, verbose=verbose, models_dir=self.models_dir)
-
-        # Initialise the face alignemnt networks
-        self.face_alignment_net = FAN(network_size)
-        if landmarks_type == LandmarksType._2D:
-            network_name = '2DFAN-' + str(network_size)
-        else:
-            network_name = '3DFAN-' + str(network_size)
-
-        fan_weights = load_or_download(
-            self.models_dir, models_urls[network_name], map_location=lambda storage, loc: storage)
-        self.face_alignment_net.load_state_dict(fan_weights)
-
-        self.face_alignment_net.to(device)
-        self.face_alignment_net.eval()
-
-        # Initialiase the depth prediciton network
-        if landmarks_type == LandmarksType._3D:
-            self.depth_prediciton_net = ResNetDepth()
+            device=device, verbose=verbose, models_dir=self.models_dir, **(face_detector_kwargs or {}))
+
+        self._face_alignment_net = None
+        self._depth_prediciton_net = None
+
+    @property
+    def face_alignment_net(self):
+        if self._face_alignment_net is None:
+            # Initialise the face alignemnt networks
+            face_alignment_net = FAN(self.network_size)
+            if self.landmarks_type == LandmarksType._2D:
+                network_name = '2DFAN-' + str(self.network_size)
+            else:
+                network_name = '3DFAN-' + str(self.network_size)
+
+            fan_weights = load_or_download(
+                self.models_dir, models_urls[network_name], map_location=lambda storage, loc: storage)
+            face_alignment_net.load_state_dict(fan_weights)
+
+            face_alignment_net.to(self.device)
+            face_alignment_net.eval()
+            self._face_alignment_net = face_alignment_net
+        return self._face_alignment_net
+
+    @property
+    def depth_prediciton_net(self):
+        if self._depth_prediciton_net is None:
+            if self.landmarks_type != LandmarksType._3D:
+                raise AttributeError("depth prediction network is used for 3D landmarks only")
+            # Initialiase the depth prediciton network
+            depth_prediciton_net = ResNetDepth()
 
             depth_weights = load_or_download(
                 self.models_dir, models_urls['depth'], map_location=lambda storage, loc: storage)
             depth_dict = {
                 k.replace('module.', ''): v for k,
                 v in depth_weights['state_dict'].items()}
-            self.depth_prediciton_net.load_state_dict(depth_dict)
+            depth_prediciton_net.load_state_dict(depth_dict)
 
-            self.depth_prediciton_net.to(device)
-            self.depth_prediciton_net.eval()
+            depth_prediciton_net.to(self.device)
+            depth_prediciton_net.eval()
+            self._depth_prediciton_net = depth_prediciton_net
+        return self._depth_prediciton_net
 
     def get_faces_and_landmarks(self, image_or_path, detected_faces=None):
         """Deprecated, please use get_landmarks_from_image
@@ -127,6 +145,58 @@ class FaceAlignment:
             detected_faces {list of numpy.array} -- list of bounding boxes, one for each face found
             in the image (default: {None})
         """
+        image = self._load_image(image_or_path)
+        if image is None:
+            return None
+        return self.get_landmarks_from_batch(
+            [image], None if detected_faces is None else [detected_faces])[0]
+
+    @torch.no_grad()
+    def get_landmarks_from_batch(self, images_or_paths, detected_faces=None, batch_size=32):
+        """Predict the landmarks for each face present in each of the images,
+        as get_landmarks_from_image does for one of them. Faces of all images
+        are cropped together and run through the network batch_size at once.
+
+         Arguments:
+            images_or_paths {list of string, numpy.array or torch.tensor} -- The input images or paths to them.
+
+        Keyword Arguments:
+            detected_faces {list of lists of numpy.array} -- bounding boxes of the faces found
+            in each image (default: {None})
+            batch_size {int} -- faces in one forward pass (default: {32})
+
+        Returns:
+            [A list of landmarks for each image, None for an image without faces]
+        """
+        images = [self._load_image(image_or_path) for image_or_path in images_or_paths]
+
+        if detected_faces is None:
+            detected_faces = self._detect_batch(images)
+
+        faces = []
+        for image_index, (image, image_faces) in enumerate(zip(images, detected_faces)):
+            if image is None:
+                continue
+            if len(image_faces) == 0:
+                logging.warn("Warning: No faces were detected.")
+                continue
+            for d in image_faces:
+                center = torch.FloatTensor(
+                    [d[2] - (d[2] - d[0]) / 2.0, d[3] - (d[3] - d[1]) / 2.0])
+                center[1] = center[1] - (d[3] - d[1]) * 0.12
+                scale = (d[2] - d[0] + d[3] - d[1]) / self.face_detector.reference_scale
+                faces.append((image_index, center, scale))
+
+        landmarks = [None if image is None or len(image_faces) == 0 else []
+                     for image, image_faces in zip(images, detected_faces)]
+        for i in range(0, len(faces), batch_size):
+            batch = faces[i:i + batch_size]
+            for (image_index, _, _), pts_img in zip(batch, self._landmarks_of_faces(images, batch)):
+                landmarks[image_index].append(pts_img)
+
+        return landmarks
+
+    def _load_image(self, image_or_path):
         if isinstance(image_or_path, str):
             try:
                 image = io.imread(image_or_path)
@@ -142,55 +212,50 @@ class FaceAlignment:
             image = color.gray2rgb(image)
         elif image.ndim == 4:
             image = image[..., :3]
-
-        if detected_faces is None:
-            detected_faces = self.face_detector.detect_from_image(image[..., ::-1].copy())
-
-        if len(detected_faces) == 0:
-            logging.warn("Warning: No faces were detected.")
-            return None
-
-        landmarks = []
-        for i, d in enumerate(detected_faces):
-            center = torch.FloatTensor(
-                [d[2] - (d[2] - d[0]) / 2.0, d[3] - (d[3] - d[1]) / 2.0])
-            center[1] = center[1] - (d[3] - d[1]) * 0.12
-            scale = (d[2] - d[0] + d[3] - d[1]) / self.face_detector.reference_scale
-
-            inp = crop(image, center, scale)
-            inp = torch.from_numpy(inp.transpose(
-                (2, 0, 1))).float()
-
-            inp = inp.to(self.device)
-            inp.div_(255.0).unsqueeze_(0)
-
-            out = self.face_alignment_net(inp)[-1].detach()
-            if self.flip_input:
-                out += flip(self.face_alignment_net(flip(inp))
-                            [-1].detach(), is_label=True)
-            out = out.cpu()
-
-            pts, pts_img = get_preds_fromhm(out, center, scale)
-            pts, pts_img = pts.view(68, 2) * 4, pts_img.view(68, 2)
-
-            if self.landmarks_type == LandmarksType._3D:
-                heatmaps = np.zeros((68, 256, 256), dtype=np.float32)
-                for i in range(68):
-                    if pts[i, 0] > 0:
-                        heatmaps[i] = draw_gaussian(
-                            heatmaps[i], pts[i], 2)
-                heatmaps = torch.from_numpy(
-                    heatmaps).unsqueeze_(0)
-
-                heatmaps = heatmaps.to(self.device)
-                depth_pred = self.depth_prediciton_net(
-                    torch.cat((inp, heatmaps), 1)).data.cpu().view(68, 1)
-                pts_img = torch.cat(
-                    (pts_img, depth_pred * (1.0 / (256.0 / (200.0 * scale)))), 1)
-
-            landmarks.append(pts_img.numpy())
-
-        return landmarks
+        return image
+
+    def _detect_batch(self, images):
+        loaded = [image for image in images if image is not None]
+        if loaded and all(image.shape == loaded[0].shape for image in loaded):
+            faces = iter(self.face_detector.detect_from_batch([image[..., ::-1].copy() for image in loaded]))
+            return [[] if image is None else next(faces) for image in images]
+        return [[] if image is None else self.face_detector.detect_from_image(image[..., ::-1].copy())
+                for image in images]
+
+    def _landmarks_of_faces(self, images, faces):
+        """Returns landmarks of (image index, center, scale) faces of images,
+        predicted in one forward pass (and one more with flip_input)."""
+        inp = np.empty((len(faces), 256, 256, 3), dtype=np.uint8)
+        for i, (image_index, center, scale) in enumerate(faces):
+            crop(images[image_index], center, scale, out=inp[i])
+        inp = torch.from_numpy(inp.transpose((0, 3, 1, 2))).float()
+
+        inp = inp.to(self.device)
+        inp.div_(255.0)
+
+        out = self.face_alignment_net(inp)[-1].detach()
+        if self.flip_input:
+            out += flip(self.face_alignment_net(flip(inp))
+                        [-1].detach(), is_label=True)
+        out = out.cpu()
+
+        centers = torch.stack([center for _, center, _ in faces])
+        scales = torch.tensor([scale for _, _, scale in faces], dtype=torch.float32)
+        pts, pts_img = get_preds_fromhm(out, centers, scales)
+        pts = pts * 4
+
+        if self.landmarks_type == LandmarksType._3D:
+            heatmaps = np.zeros((len(faces), 68, 256, 256), dtype=np.float32)
+            draw_gaussians(heatmaps, pts.numpy(), 2, visible=pts[..., 0].numpy() > 0)
+            heatmaps = torch.from_numpy(heatmaps)
+
+            heatmaps = heatmaps.to(self.device)
+            depth_pred = self.depth_prediciton_net(
+                torch.cat((inp, heatmaps), 1)).data.cpu().view(len(faces), 68, 1)
+            pts_img = torch.cat(
+                (pts_img, depth_pred * (1.0 / (256.0 / (200.0 * scales.view(-1, 1, 1))))), 2)
+
+        return [face_pts_img.numpy() for face_pts_img in pts_img]
 
     def get_landmarks_from_directory(self, path, extensions=['.jpg', '.png'],
                                      recursive=True, show_progress_bar=True, need_faces_count=None):
@@ -53,6 +53,27 @@ class FaceDetector(object):
         """
         raise NotImplementedError
 
+    def detect_from_batch(self, images, threshold=.5, bgr=False):
+        """Detects faces in a batch of images of the same size.
+
+        Detectors able to run several images through the network at once
+        should override it, the default implementation calls
+        ``detect_from_image`` for each image.
+
+        Arguments:
+            images {list of numpy.ndarray or numpy.ndarray} -- the images, a
+            list of them or an array of shape [B, H, W, C]
+
+        Keyword Arguments:
+            bgr {bool} -- the images have channels in reverse order, as cv2 reads them (default: {False})
+
+        Returns:
+            [A list of lists of bounding boxes (x1, y1, x2, y2), one for each image]
+        """
+        if bgr:
+            images = [image[..., ::-1].copy() for image in images]
+        return [self.detect_from_image(image, threshold=threshold) for image in images]
+
     def detect_from_directory(self, path, extensions=['.jpg', '.png'], recursive=False, show_progress_bar=True):
         """Detects faces from all the images present in a given directory.
 
@@ -0,0 +1,170 @@
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+
+import torch
+
+from .net_s3fd import s3fd
+
+TORCH = 'torch'
+# frozen torch.jit trace
+TORCHSCRIPT = 'torchscript'
+ONNXRUNTIME = 'onnxruntime'
+
+BACKENDS = (TORCH, TORCHSCRIPT, ONNXRUNTIME)
+
+# fixed shape models are exported, traced and warmed up with
+INPUT_SIZE = (300, 300)
+
+
+class BackendException(Exception):
+    pass
+
+
+class TorchBackend(object):
+    """Runs s3fd as is, [B, 3, H, W] float tensor in, list of its
+    classification and regression outputs for each feature map out."""
+
+    def __init__(self, net):
+        self.net = net
+
+    def __call__(self, imgs):
+        return list(self.net(imgs))
+
+    def warm_up(self, device, batch_size=1, size=INPUT_SIZE):
+        width, height = size
+        with torch.no_grad():
+            self(torch.zeros((batch_size, 3, height, width), dtype=torch.float32, device=device))
+
+
+class TorchScriptBackend(TorchBackend):
+
+    def __init__(self, path, device):
+        super(TorchScriptBackend, self).__init__(torch.jit.load(path, map_location=device))
+
+
+class OnnxRuntimeBackend(TorchBackend):
+    """Runs the exported ONNX model with onnxruntime on CPU, outputs are
+    returned as CPU tensors."""
+
+    def __init__(self, path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise BackendException("onnxruntime is not installed")
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self._input_name = session.get_inputs()[0].name
+        super(OnnxRuntimeBackend, self).__init__(session)
+
+    def __call__(self, imgs):
+        outputs = self.net.run(None, {self._input_name: imgs.cpu().numpy()})
+        return [torch.from_numpy(output) for output in outputs]
+
+
+def model_path(weights_file, backend):
+    """Returns the exported model file stored next to weights_file."""
+    base = os.path.splitext(weights_file)[0]
+    if backend == TORCHSCRIPT:
+        return base + '.torchscript.pt'
+    if backend == ONNXRUNTIME:
+        return base + '.onnx'
+    raise BackendException("no exported model for backend %s" % backend)
+
+
+def export_torchscript(net, path, device='cpu', size=INPUT_SIZE):
+    width, height = size
+    example = torch.zeros((1, 3, height, width), dtype=torch.float32, device=device)
+    with torch.no_grad():
+        traced = torch.jit.trace(net, example, strict=False)
+        frozen = torch.jit.freeze(traced.eval())
+    frozen.save(path)
+    logging.info("s3fd exported to TorchScript %s" % path)
+
+
+def export_onnx(net, path, device='cpu', size=INPUT_SIZE):
+    width, height = size
+    example = torch.zeros((1, 3, height, width), dtype=torch.float32, device=device)
+    # classification and regression outputs of 6 feature maps, [B, C, h, w]
+    # with h and w following the input size
+    output_names = ['%s%d' % (kind, i) for i in range(6) for kind in ('cls', 'reg')]
+    dynamic_axes = {'input': {0: 'batch', 2: 'height', 3: 'width'}}
+    for i in range(6):
+        for kind in ('cls', 'reg'):
+            dynamic_axes['%s%d' % (kind, i)] = {0: 'batch', 2: 'height%d' % i, 3: 'width%d' % i}
+    with torch.no_grad():
+        torch.onnx.export(
+            net, example, path,
+            input_names=['input'], output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=11,
+        )
+    logging.info("s3fd exported to ONNX %s" % path)
+
+
+def export(net, path, backend, device='cpu', size=INPUT_SIZE):
+    """Exports net for backend to path. The model is written to a temp dir
+    next to path first and then moved there, so concurrent workers never
+    load a partial one. Files written along with it (ONNX external data)
+    are moved before the model."""
+    if backend not in (TORCHSCRIPT, ONNXRUNTIME):
+        raise BackendException("nothing to export for backend %s" % backend)
+    temp_dir = tempfile.mkdtemp(prefix='.export-', dir=os.path.dirname(path) or '.')
+    try:
+        temp_file = os.path.join(temp_dir, os.path.basename(path))
+        if backend == TORCHSCRIPT:
+            export_torchscript(net, temp_file, device=device, size=size)
+        else:
+            export_onnx(net, temp_file, device=device, size=size)
+        for name in sorted(os.listdir(temp_dir), key=lambda name: name == os.path.basename(path)):
+            os.replace(os.path.join(temp_dir, name), os.path.join(os.path.dirname(path), name))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def load_backend(backend, net, device, path=None):
+    """Returns a runner of net for backend. The exported model is loaded
+    from path, it is exported from net there first when missing."""
+    if backend == TORCH:
+        return TorchBackend(net)
+    if backend not in BACKENDS:
+        raise BackendException("unknown detector backend %s" % backend)
+    if backend == ONNXRUNTIME and 'cpu' not in device:
+        raise BackendException("onnxruntime backend runs on cpu only, device is %s" % device)
+    if path is None:
+        raise BackendException("no model path for backend %s" % backend)
+
+    if not os.path.isfile(path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        export(net, path, backend, device=device)
+
+    if backend == TORCHSCRIPT:
+        return TorchScriptBackend(path, device)
+    return OnnxRuntimeBackend(path)
+
+
+def main():
+    from ...utils import load_or_download
+    from .sfd_detector import models_urls
+
+    parser = argparse.ArgumentParser(description='Export s3fd weights for the torchscript and onnxruntime backends')
+    parser.add_argument('--models-dir', type=str, default='./models', help='Dir with s3fd weights to export next to')
+    parser.add_argument('--backend', type=str, default=None, choices=BACKENDS[1:],
+                        help='Export for this backend only, for all if not set')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    net = s3fd()
+    net.load_state_dict(load_or_download(args.models_dir, models_urls['s3fd'], map_location='cpu'))
+    net.eval()
+
+    weights_file = os.path.join(args.models_dir, os.path.basename(models_urls['s3fd']))
+    os.makedirs(args.models_dir, exist_ok=True)
+    for backend in [args.backend] if args.backend else BACKENDS[1:]:
+        export(net, model_path(weights_file, backend), backend)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,11 @@ import argparse
 import numpy as np
 import torch
 
+try:
+    from torchvision.ops import batched_nms as _torchvision_batched_nms
+except ImportError:
+    _torchvision_batched_nms = None
+
 try:
     from iou import IOU
 except BaseException:
@@ -64,6 +69,74 @@ def nms(dets, thresh):
     return keep
 
 
+def batch_nms(dets, image_index, thresh, score_threshold=0., max_pairwise=2048):
+    """Non-maximum suppression of detections of several images at once, as
+    ``nms`` does for each image.
+
+    Arguments:
+        dets {numpy.array} -- [N, 5] detections (x1, y1, x2, y2, score)
+        image_index {numpy.array} -- [N] index of the image of each detection
+        thresh {float} -- IoU above which a detection is suppressed
+
+    Keyword Arguments:
+        score_threshold {float} -- detections with lower score are dropped before
+        suppression, they could only suppress even lower ones (default: {0.})
+        max_pairwise {int} -- above this many candidates the pairwise IoU matrix
+        is not built, they are suppressed one by one as ``nms`` does (default: {2048}).
+        Only used when torchvision is not installed.
+
+    Returns:
+        indices of kept detections, by descending score
+    """
+    candidates = np.where(dets[:, 4] > score_threshold)[0]
+    if 0 == len(candidates):
+        return candidates
+    if _torchvision_batched_nms is not None:
+        boxes = dets[candidates, :4].astype(np.float64)
+        # torchvision has no +1 in box sizes, widen the boxes to get the same IoU as ``nms``
+        boxes[:, 2:] += 1
+        keep = _torchvision_batched_nms(torch.from_numpy(boxes),
+                                        torch.from_numpy(dets[candidates, 4].astype(np.float64)),
+                                        torch.from_numpy(np.asarray(image_index)[candidates]),
+                                        thresh)
+        return candidates[keep.numpy()]
+    order = candidates[np.argsort(-dets[candidates, 4], kind='stable')]
+
+    x1, y1, x2, y2 = (dets[order, i].astype(np.float64) for i in range(4))
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    if len(order) > max_pairwise:
+        return order[_greedy_nms(x1, y1, x2, y2, areas, image_index[order], thresh)]
+
+    xx1, yy1 = np.maximum(x1[:, None], x1[None, :]), np.maximum(y1[:, None], y1[None, :])
+    xx2, yy2 = np.minimum(x2[:, None], x2[None, :]), np.minimum(y2[:, None], y2[None, :])
+    inter = np.maximum(0.0, xx2 - xx1 + 1) * np.maximum(0.0, yy2 - yy1 + 1)
+    ovr = inter / (areas[:, None] + areas[None, :] - inter)
+    index = image_index[order]
+    suppress = (ovr > thresh) & (index[:, None] == index[None, :])
+
+    keep = np.ones(len(order), dtype=bool)
+    for i in range(len(order)):
+        if keep[i]:
+            keep[i + 1:] &= ~suppress[i, i + 1:]
+
+    return order[keep]
+
+
+def _greedy_nms(x1, y1, x2, y2, areas, index, thresh):
+    # indices of kept boxes sorted by descending score, suppressing only within an image
+    rest = np.arange(len(x1))
+    keep = []
+    while rest.size > 0:
+        i, rest = rest[0], rest[1:]
+        keep.append(i)
+        xx1, yy1 = np.maximum(x1[i], x1[rest]), np.maximum(y1[i], y1[rest])
+        xx2, yy2 = np.minimum(x2[i], x2[rest]), np.minimum(y2[i], y2[rest])
+        inter = np.maximum(0.0, xx2 - xx1 + 1) * np.maximum(0.0, yy2 - yy1 + 1)
+        ovr = inter / (areas[i] + areas[rest] - inter)
+        rest = rest[(ovr <= thresh) | (index[rest] != index[i])]
+    return np.array(keep, dtype=np.int64)
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
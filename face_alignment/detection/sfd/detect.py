@@ -17,43 +17,115 @@ from .bbox import *
 
 
 def detect(net, img, device):
-    img = img - np.array([104, 117, 123])
-    img = img.transpose(2, 0, 1)
-    img = img.reshape((1,) + img.shape)
+    return batch_detect(net, img.reshape((1,) + img.shape), device)[0]
 
+
+class InputBuffer(object):
+    """Reusable [B, 3, H, W] float32 network input, pinned for a CUDA device.
+    One is kept for each image size, grown to the largest batch filled."""
+
+    mean = (104, 117, 123)
+
+    def __init__(self, device):
+        self.device = device
+        self._buffers = {}
+
+    def fill(self, imgs, swap_rb=False):
+        """Writes [B, H, W, 3] images (or a list of [H, W, 3] ones of the same
+        size) minus the mean in CHW order and returns the input on device.
+        With swap_rb channels are taken in reverse, e.g. of BGR cv2 frames."""
+        batch_size = len(imgs)
+        height, width = imgs[0].shape[:2]
+        buffer = self._buffers.get((height, width))
+        if buffer is None or buffer.shape[0] < batch_size:
+            buffer = torch.empty(
+                (batch_size, 3, height, width), dtype=torch.float32, pin_memory='cuda' in self.device)
+            self._buffers[(height, width)] = buffer
+        buffer = buffer[:batch_size]
+
+        input = buffer.numpy()
+        for i, img in enumerate(imgs):
+            for c in range(3):
+                np.subtract(img[..., 2 - c if swap_rb else c], self.mean[c], out=input[i, c], dtype=np.float32)
+        return buffer.to(self.device, non_blocking=True)
+
+
+def preprocess(imgs, device):
+    """Returns [B, 3, H, W] float network input of [B, H, W, 3] images."""
+    return InputBuffer(device).fill(imgs)
+
+
+def batch_detect(net, imgs, device, input_buffer=None, swap_rb=False):
+    """Returns a list of detections for each of [B, H, W, 3] images (or a
+    list of same sized images), filled into input_buffer if given."""
     if 'cuda' in device:
         torch.backends.cudnn.benchmark = True
 
-    img = torch.from_numpy(img).float().to(device)
-    BB, CC, HH, WW = img.size()
+    imgs = (input_buffer or InputBuffer(device)).fill(imgs, swap_rb=swap_rb)
+    BB, CC, HH, WW = imgs.size()
     with torch.no_grad():
-        olist = net(img)
+        olist = net(imgs)
 
-    bboxlist = []
     for i in range(len(olist) // 2):
         olist[i * 2] = F.softmax(olist[i * 2], dim=1)
     olist = [oelem.data.cpu() for oelem in olist]
+
+    variances = [0.1, 0.2]
+    dets_per_image = [[] for _ in range(BB)]
     for i in range(len(olist) // 2):
         ocls, oreg = olist[i * 2], olist[i * 2 + 1]
         FB, FC, FH, FW = ocls.size()  # feature map size
         stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[0, 1, hindex, windex]
-            loc = oreg[0, :, hindex, windex].contiguous().view(1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]])
-            variances = [0.1, 0.2]
-            box = decode(loc, priors, variances)
-            x1, y1, x2, y2 = box[0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append([x1, y1, x2, y2, score])
-    bboxlist = np.array(bboxlist)
-    if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, 5))
+        scores = ocls[:, 1, :, :]
+        bindex, hindex, windex = torch.nonzero(scores > 0.05, as_tuple=True)
+        if bindex.numel() == 0:
+            continue
+        priors = prior_grid(FH, FW, stride)[hindex, windex]
+        loc = oreg.permute(0, 2, 3, 1)[bindex, hindex, windex]
+        boxes = decode(loc, priors, variances)
+        dets = torch.cat((boxes, scores[bindex, hindex, windex].unsqueeze(1)), 1)
+        for b in range(BB):
+            dets_per_image[b].append(dets[bindex == b])
 
-    return bboxlist
+    bboxlists = []
+    for dets in dets_per_image:
+        bboxlist = torch.cat(dets).numpy() if dets else []
+        if 0 == len(bboxlist):
+            bboxlist = np.zeros((1, 5), dtype=np.float32)
+        bboxlists.append(bboxlist)
+
+    return bboxlists
+
+
+def batch_faces(net, imgs, device, threshold=.5, input_buffer=None, swap_rb=False):
+    """Returns a list of face detections (x1, y1, x2, y2, score) with score
+    above threshold for each of images, after NMS (see batch_detect)."""
+    bboxlists = batch_detect(net, imgs, device, input_buffer=input_buffer, swap_rb=swap_rb)
+    dets = np.concatenate(bboxlists)
+    image_index = np.repeat(np.arange(len(bboxlists)), [len(bboxlist) for bboxlist in bboxlists])
+    keep = batch_nms(dets, image_index, 0.3, score_threshold=threshold)
+
+    faces = [[] for _ in bboxlists]
+    for k in keep:
+        faces[image_index[k]].append(dets[k])
+    return faces
+
+
+_prior_grids = {}
+
+
+def prior_grid(height, width, stride):
+    """Returns [height, width, 4] priors (cx, cy, w, h) of a feature map,
+    cached for each map size and stride."""
+    key = (height, width, stride)
+    priors = _prior_grids.get(key)
+    if priors is None:
+        cy = (torch.arange(height, dtype=torch.float32) * stride + stride / 2).view(-1, 1).expand(height, width)
+        cx = (torch.arange(width, dtype=torch.float32) * stride + stride / 2).view(1, -1).expand(height, width)
+        size = torch.full((height, width), stride * 4., dtype=torch.float32)
+        priors = torch.stack((cx, cy, size, size), 2)
+        _prior_grids[key] = priors
+    return priors
 
 
 def flip_detect(net, img, device):
@@ -0,0 +1,155 @@
+import argparse
+import glob
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from .backends import INPUT_SIZE, TorchBackend, TorchScriptBackend
+from .detect import batch_faces, preprocess
+from .net_s3fd import s3fd
+
+
+class QuantizeException(Exception):
+    pass
+
+
+def quantized_path(weights_file):
+    """Returns the INT8 model file stored next to weights_file."""
+    return os.path.splitext(weights_file)[0] + '.int8.pt'
+
+
+def _engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise QuantizeException("no quantized engine in %s" % engines)
+
+
+def load_images(images_dir, size=INPUT_SIZE, limit=None):
+    """Returns [N, H, W, 3] RGB detector input of .jpg and .png frames in
+    images_dir, resized to size as detect.resize_for_detector does."""
+    files = sorted(glob.glob(os.path.join(images_dir, '*.jpg')) + glob.glob(os.path.join(images_dir, '*.png')))
+    if limit:
+        files = files[:limit]
+    if not files:
+        raise QuantizeException("no .jpg or .png frames in %s" % images_dir)
+    return np.stack([
+        cv2.resize(cv2.imread(file), size, interpolation=cv2.INTER_AREA)[..., ::-1]
+        for file in files
+    ])
+
+
+def quantize(net, images, batch_size=8):
+    """Returns s3fd net statically quantized to INT8 (FX graph mode) with
+    activation ranges calibrated on [N, H, W, 3] images. Ops without
+    quantized kernels (L2Norm, the background max-out) stay in float."""
+    try:
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+    except ImportError:
+        raise QuantizeException("torch %s has no FX graph mode quantization" % torch.__version__)
+
+    engine = _engine()
+    torch.backends.quantized.engine = engine
+    example = preprocess(images[:1], 'cpu')
+    prepared = prepare_fx(net.cpu().eval(), get_default_qconfig_mapping(engine), (example,))
+    with torch.no_grad():
+        for i in range(0, len(images), batch_size):
+            prepared(preprocess(images[i:i + batch_size], 'cpu'))
+    return convert_fx(prepared)
+
+
+def save(quantized, path, size=INPUT_SIZE):
+    """Traces quantized and saves it to path, through a temp file of this
+    process so concurrent workers never load a partial model."""
+    width, height = size
+    example = torch.zeros((1, 3, height, width), dtype=torch.float32)
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, example, strict=False)
+    temp_file = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        traced.save(temp_file)
+        os.replace(temp_file, path)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    logging.info("INT8 s3fd saved to %s" % path)
+
+
+def load(path):
+    """Returns a runner of the INT8 model saved to path, it runs on CPU."""
+    torch.backends.quantized.engine = _engine()
+    return TorchScriptBackend(path, 'cpu')
+
+
+def load_or_quantize(net, weights_file, calibration_dir=None, calibration_frames=200):
+    """Returns a runner of the INT8 model cached next to weights_file,
+    quantizing net calibrated on frames in calibration_dir if it is missing."""
+    path = quantized_path(weights_file)
+    if not os.path.isfile(path):
+        if calibration_dir is None:
+            raise QuantizeException("no quantized face detector %s, calibration frames dir is required" % path)
+        save(quantize(net, load_images(calibration_dir, limit=calibration_frames)), path)
+    return load(path)
+
+
+def compare(float_runner, quantized_runner, images, threshold=.5, batch_size=8):
+    """Runs both detectors on [N, H, W, 3] images, returns a dict with
+    numbers of frames whose face count or one-face decision (as checked by
+    check_frame) differs and frames per second of each."""
+    counts = {}
+    seconds = {}
+    for name, runner in (('float', float_runner), ('int8', quantized_runner)):
+        start = time.time()
+        counts[name] = []
+        for i in range(0, len(images), batch_size):
+            counts[name] += [len(faces) for faces in batch_faces(runner, images[i:i + batch_size], 'cpu', threshold)]
+        seconds[name] = time.time() - start
+    float_counts, int8_counts = np.array(counts['float']), np.array(counts['int8'])
+    return {
+        "frames": len(images),
+        "changed_counts": int(np.sum(float_counts != int8_counts)),
+        "changed_decisions": int(np.sum((float_counts == 1) != (int8_counts == 1))),
+        "float_fps": len(images) / seconds['float'],
+        "int8_fps": len(images) / seconds['int8'],
+    }
+
+
+def main():
+    from ...utils import load_or_download
+    from .sfd_detector import models_urls
+
+    parser = argparse.ArgumentParser(description='Quantize s3fd to INT8 and compare its decisions with FP32')
+    parser.add_argument('--models-dir', type=str, default='./models', help='Dir with s3fd weights to store INT8 next to')
+    parser.add_argument('--calibration-dir', type=str, required=True, help='Dir with .jpg or .png frames to calibrate on')
+    parser.add_argument('--calibration-frames', type=int, default=200, help='Calibrate on first N frames')
+    parser.add_argument('--compare-dir', type=str, default=None,
+                        help='Dir with frames to compare decisions on, calibration frames if not set')
+    parser.add_argument('--face-detect-threshold', type=float, default=.5, help='Face detect threshold')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    torch.set_grad_enabled(False)
+    net = s3fd()
+    net.load_state_dict(load_or_download(args.models_dir, models_urls['s3fd'], map_location='cpu'))
+    net.eval()
+
+    weights_file = os.path.join(args.models_dir, os.path.basename(models_urls['s3fd']))
+    os.makedirs(args.models_dir, exist_ok=True)
+    quantized = load_or_quantize(net, weights_file, args.calibration_dir, args.calibration_frames)
+
+    images = load_images(args.compare_dir or args.calibration_dir)
+    report = compare(TorchBackend(net), quantized, images, threshold=args.face_detect_threshold)
+    logging.info(
+        "{frames} frames: one face decision changed on {changed_decisions}, face count on {changed_counts}, "
+        "FP32 {float_fps:.1f} fps, INT8 {int8_fps:.1f} fps".format(**report)
+    )
+
+
+if __name__ == '__main__':
+    main()
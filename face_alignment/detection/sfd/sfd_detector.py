@@ -6,6 +6,8 @@ from ..core import FaceDetector
 from .net_s3fd import s3fd
 from .bbox import *
 from .detect import *
+from .backends import TORCH, BackendException, load_backend, model_path
+from . import quantize
 from ...utils import load_or_download
 
 models_urls = {
@@ -14,29 +16,49 @@ models_urls = {
 
 
 class SFDDetector(FaceDetector):
-    def __init__(self, device, path_to_detector=None, verbose=False, models_dir=None):
+    """S3FD face detector. backend is one of backends.BACKENDS, exported
+    torchscript and onnxruntime models are stored next to the weights.
+    quantized runs the INT8 model cached next to the weights instead (CPU
+    only), it is calibrated on frames in calibration_dir when missing."""
+
+    def __init__(self, device, path_to_detector=None, verbose=False, models_dir=None, backend=TORCH,
+                 quantized=False, calibration_dir=None):
         super(SFDDetector, self).__init__(device, verbose, models_dir)
 
         # Initialise the face detector
         if path_to_detector is None:
             model_weights = load_or_download(self.models_dir, models_urls['s3fd'])
+            weights_dir = self.models_dir or os.path.join(torch.hub.get_dir(), 'checkpoints')
+            weights_file = os.path.join(weights_dir, os.path.basename(models_urls['s3fd']))
         else:
             model_weights = torch.load(path_to_detector)
+            weights_file = path_to_detector
 
         self.face_detector = s3fd()
         self.face_detector.load_state_dict(model_weights)
         self.face_detector.to(device)
         self.face_detector.eval()
 
-    def detect_from_image(self, tensor_or_path, threshold=.5):
-        image = self.tensor_or_path_to_ndarray(tensor_or_path)
+        self.backend = backend
+        if quantized:
+            if backend != TORCH or 'cpu' not in device:
+                raise BackendException("quantized face detector runs with torch on cpu only")
+            self.face_detector = quantize.load_or_quantize(self.face_detector, weights_file, calibration_dir)
+        else:
+            self.face_detector = load_backend(
+                backend, self.face_detector, device,
+                path=model_path(weights_file, backend) if backend != TORCH else None,
+            )
+        self.face_detector.warm_up(device)
+        self._input_buffer = InputBuffer(device)
 
-        bboxlist = detect(self.face_detector, image, device=self.device)
-        keep = nms(bboxlist, 0.3)
-        bboxlist = bboxlist[keep, :]
-        bboxlist = [x for x in bboxlist if x[-1] > threshold]
+    def detect_from_image(self, tensor_or_path, threshold=.5):
+        return self.detect_from_batch([tensor_or_path], threshold=threshold)[0]
 
-        return bboxlist
+    def detect_from_batch(self, images, threshold=.5, bgr=False):
+        images = [self.tensor_or_path_to_ndarray(image) for image in images]
+        return batch_faces(self.face_detector, images, self.device, threshold=threshold,
+                           input_buffer=self._input_buffer, swap_rb=bgr)
 
     @property
     def reference_scale(self):
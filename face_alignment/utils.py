@@ -24,17 +24,30 @@ def _gaussian(
         sigma_vert = sigma
     center_x = mean_horz * width + 0.5
     center_y = mean_vert * height + 0.5
-    gauss = np.empty((height, width), dtype=np.float32)
     # generate kernel
-    for i in range(height):
-        for j in range(width):
-            gauss[i][j] = amplitude * math.exp(-(math.pow((j + 1 - center_x) / (
-                sigma_horz * width), 2) / 2.0 + math.pow((i + 1 - center_y) / (sigma_vert * height), 2) / 2.0))
+    j = (np.arange(width) + 1 - center_x) / (sigma_horz * width)
+    i = (np.arange(height) + 1 - center_y) / (sigma_vert * height)
+    gauss = (amplitude * np.exp(-(j[None, :] ** 2 / 2.0 + i[:, None] ** 2 / 2.0))).astype(np.float32)
     if normalize:
         gauss = gauss / np.sum(gauss)
     return gauss
 
 
+_gaussian_kernels = {}
+
+
+def gaussian_kernel(size, sigma=0.25):
+    """Returns ``_gaussian(size, sigma)``, cached for each size and sigma.
+    The kernel is shared between calls and must not be modified."""
+    key = (size, sigma)
+    kernel = _gaussian_kernels.get(key)
+    if kernel is None:
+        kernel = _gaussian(size, sigma)
+        kernel.setflags(write=False)
+        _gaussian_kernels[key] = kernel
+    return kernel
+
+
 def draw_gaussian(image, point, sigma):
     # Check if the gaussian is inside
     ul = [math.floor(point[0] - 3 * sigma), math.floor(point[1] - 3 * sigma)]
@@ -42,7 +55,7 @@ def draw_gaussian(image, point, sigma):
     if (ul[0] > image.shape[1] or ul[1] > image.shape[0] or br[0] < 1 or br[1] < 1):
         return image
     size = 6 * sigma + 1
-    g = _gaussian(size)
+    g = gaussian_kernel(size)
     g_x = [int(max(1, -ul[0])), int(min(br[0], image.shape[1])) - int(max(1, ul[0])) + int(max(1, -ul[0]))]
     g_y = [int(max(1, -ul[1])), int(min(br[1], image.shape[0])) - int(max(1, ul[1])) + int(max(1, -ul[1]))]
     img_x = [int(max(1, ul[0])), int(min(br[0], image.shape[1]))]
@@ -54,6 +67,56 @@ def draw_gaussian(image, point, sigma):
     return image
 
 
+def _kernel_window(ul, br, length, size):
+    # image and kernel index of each of the size window pixels along one
+    # axis as draw_gaussian pastes them, and whether the pixel is pasted
+    img_start = np.maximum(1, ul) - 1
+    img_stop = np.minimum(br, length)
+    g_start = np.maximum(1, -ul) - 1
+    offsets = np.arange(size)
+    img_index = img_start[:, None] + offsets
+    g_index = g_start[:, None] + offsets
+    pasted = (img_index < img_stop[:, None]) & (g_index < size)
+    return np.minimum(img_index, length - 1), np.minimum(g_index, size - 1), pasted
+
+
+def draw_gaussians(heatmaps, points, sigma, visible=None):
+    """Draws a gaussian for each point into its heatmap, as draw_gaussian
+    does, for all points of all samples at once. Only the (6 * sigma + 1)
+    windows around the points are touched, values are clipped to 1 there.
+
+    Arguments:
+        heatmaps {numpy.array} -- [B, N, H, W] float32 heatmaps, drawn into in place
+        points {numpy.array or torch.tensor} -- [B, N, 2] points, one for each heatmap
+        sigma {int} -- sigma of the gaussians
+
+    Keyword Arguments:
+        visible {numpy.array} -- [B, N] mask of points to draw, all if None (default: {None})
+    """
+    height, width = heatmaps.shape[2:]
+    points = np.asarray(points, dtype=np.float64)
+    size = 6 * sigma + 1
+    g = gaussian_kernel(size)
+    ul = np.floor(points - 3 * sigma).astype(np.int64)
+    br = np.floor(points + 3 * sigma).astype(np.int64)
+    inside = (ul[..., 0] <= width) & (ul[..., 1] <= height) & (br[..., 0] >= 1) & (br[..., 1] >= 1)
+    if visible is not None:
+        inside &= np.asarray(visible, dtype=bool)
+    b, n = np.nonzero(inside)
+    if not len(b):
+        return heatmaps
+    ul, br = ul[b, n], br[b, n]
+
+    x, kx, pasted_x = _kernel_window(ul[:, 0], br[:, 0], width, size)
+    y, ky, pasted_y = _kernel_window(ul[:, 1], br[:, 1], height, size)
+    pasted = pasted_y[:, :, None] & pasted_x[:, None, :]
+    p, i, j = np.nonzero(pasted)
+    # one point for each heatmap, so pasted pixels do not repeat
+    index = (b[p], n[p], y[p, i], x[p, j])
+    heatmaps[index] = np.minimum(heatmaps[index] + g[ky[p, i], kx[p, j]], 1)
+    return heatmaps
+
+
 def transform(point, center, scale, resolution, invert=False):
     """Generate and affine transformation matrix.
 
@@ -90,9 +153,12 @@ def transform(point, center, scale, resolution, invert=False):
     return new_point.int()
 
 
-def crop(image, center, scale, resolution=256.0):
+def crop(image, center, scale, resolution=256.0, out=None):
     """Center crops an image or set of heatmaps
 
+    The face box is sampled with one affine warp straight into the
+    resolution x resolution output, as resizing the zero padded box would.
+
     Arguments:
         image {numpy.array} -- an rgb image
         center {numpy.array} -- the center of the object, usually the same as of the bounding box
@@ -100,34 +166,56 @@ def crop(image, center, scale, resolution=256.0):
 
     Keyword Arguments:
         resolution {float} -- the size of the output cropped image (default: {256.0})
+        out {numpy.array} -- uint8 array of the output shape to crop into (default: {None})
 
     Returns:
-        [type] -- [description]
-    """  # Crop around the center point
-    """ Crops the image around the center. Input is expected to be an np.ndarray """
-    ul = transform([1, 1], center, scale, resolution, True)
-    br = transform([resolution, resolution], center, scale, resolution, True)
-    # pad = math.ceil(torch.norm((ul - br).float()) / 2.0 - (br[0] - ul[0]) / 2.0)
-    if image.ndim > 2:
-        newDim = np.array([br[1] - ul[1], br[0] - ul[0],
-                           image.shape[2]], dtype=np.int32)
-        newImg = np.zeros(newDim, dtype=np.uint8)
+        [numpy.array] -- the cropped image, out if given
+    """
+    h = 200.0 * scale
+    # box corners as transform([1, 1]) and transform([resolution, resolution]) inverted give them
+    ul = [int(h / resolution + float(center[i]) - h / 2) for i in range(2)]
+    br = [int(h + float(center[i]) - h / 2) for i in range(2)]
+    # output pixel to source pixel, with pixel centers mapped as cv2.resize maps them
+    matrix = np.zeros((2, 3), dtype=np.float64)
+    for i in range(2):
+        step = (br[i] - ul[i]) / resolution
+        matrix[i, i] = step
+        matrix[i, 2] = ul[i] + 0.5 * step - 0.5
+    size = (int(resolution), int(resolution))
+    if image.dtype != np.uint8:
+        # cast as the uint8 box was cut from the image, warpAffine would
+        # also write a new array of the image type instead of into out
+        image = image.astype(np.uint8)
+    cropped = cv2.warpAffine(
+        image, matrix, size, dst=out,
+        flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_CONSTANT, borderValue=0,
+    )
+    if out is not None and cropped is not out:
+        out[...] = cropped
+        return out
+    return cropped
+
+
+def transform_batch(points, centers, scales, resolution, invert=False):
+    """Transforms points as ``transform`` does, for a batch of them at once.
+
+    Arguments:
+        points {torch.tensor} -- [B, N, 2] points
+        centers {torch.tensor} -- [B, 2] or [2] centers around which to perform the transformations
+        scales {torch.tensor or float} -- [B] or one scale of the face/object
+        resolution {float} -- the output resolution
+
+    Keyword Arguments:
+        invert {bool} -- whether to produce the inverse transformation (default: {False})
+    """
+    centers = torch.as_tensor(centers, dtype=torch.float32).view(-1, 1, 2)
+    h = 200.0 * torch.as_tensor(scales, dtype=torch.float32).view(-1, 1, 1)
+    if invert:
+        new_points = points * (h / resolution) + centers - h / 2
     else:
-        newDim = np.array([br[1] - ul[1], br[0] - ul[0]], dtype=np.int)
-        newImg = np.zeros(newDim, dtype=np.uint8)
-    ht = image.shape[0]
-    wd = image.shape[1]
-    newX = np.array(
-        [max(1, -ul[0] + 1), min(br[0], wd) - ul[0]], dtype=np.int32)
-    newY = np.array(
-        [max(1, -ul[1] + 1), min(br[1], ht) - ul[1]], dtype=np.int32)
-    oldX = np.array([max(1, ul[0] + 1), min(br[0], wd)], dtype=np.int32)
-    oldY = np.array([max(1, ul[1] + 1), min(br[1], ht)], dtype=np.int32)
-    newImg[newY[0] - 1:newY[1], newX[0] - 1:newX[1]
-           ] = image[oldY[0] - 1:oldY[1], oldX[0] - 1:oldX[1], :]
-    newImg = cv2.resize(newImg, dsize=(int(resolution), int(resolution)),
-                        interpolation=cv2.INTER_LINEAR)
-    return newImg
+        new_points = (points - centers) * (resolution / h) + resolution / 2
+    return new_points.trunc()
 
 
 def get_preds_fromhm(hm, center=None, scale=None):
@@ -139,44 +227,37 @@ def get_preds_fromhm(hm, center=None, scale=None):
         hm {torch.tensor} -- the predicted heatmaps, of shape [B, N, W, H]
 
     Keyword Arguments:
-        center {torch.tensor} -- the center of the bounding box (default: {None})
-        scale {float} -- face scale (default: {None})
+        center {torch.tensor} -- the center of the bounding box, [2] or [B, 2] one for
+        each sample (default: {None})
+        scale {float or torch.tensor} -- face scale, one or [B] for each sample (default: {None})
     """
-    max, idx = torch.max(
-        hm.view(hm.size(0), hm.size(1), hm.size(2) * hm.size(3)), 2)
-    idx += 1
-    preds = idx.view(idx.size(0), idx.size(1), 1).repeat(1, 1, 2).float()
-    preds[..., 0].apply_(lambda x: (x - 1) % hm.size(3) + 1)
-    preds[..., 1].add_(-1).div_(hm.size(2)).floor_().add_(1)
-
-    for i in range(preds.size(0)):
-        for j in range(preds.size(1)):
-            hm_ = hm[i, j, :]
-            pX, pY = int(preds[i, j, 0]) - 1, int(preds[i, j, 1]) - 1
-            if pX > 0 and pX < 63 and pY > 0 and pY < 63:
-                diff = torch.FloatTensor(
-                    [hm_[pY, pX + 1] - hm_[pY, pX - 1],
-                     hm_[pY + 1, pX] - hm_[pY - 1, pX]])
-                preds[i, j].add_(diff.sign_().mul_(.25))
+    B, N, H, W = hm.size()
+    hm_flat = hm.reshape(B, N, H * W)
+    idx = torch.argmax(hm_flat, 2)
+    preds = torch.stack(((idx % W).float(), (idx // H).float()), 2) + 1
+
+    # move by a quarter pixel towards the higher neighbour
+    pX, pY = preds[..., 0] - 1, preds[..., 1] - 1
+    inside = ((pX > 0) & (pX < W - 1) & (pY > 0) & (pY < H - 1)).unsqueeze(2)
+    neighbours = idx.unsqueeze(2) + torch.tensor([1, -1, W, -W], device=idx.device)
+    values = torch.gather(hm_flat, 2, neighbours.clamp(0, H * W - 1))
+    diff = torch.stack((values[..., 0] - values[..., 1], values[..., 2] - values[..., 3]), 2)
+    preds += diff.sign() * .25 * inside
 
     preds.add_(-.5)
 
     preds_orig = torch.zeros(preds.size())
     if center is not None and scale is not None:
-        for i in range(hm.size(0)):
-            for j in range(hm.size(1)):
-                preds_orig[i, j] = transform(
-                    preds[i, j], center, scale, hm.size(2), True)
+        preds_orig = transform_batch(preds, center, scale, H, True)
 
     return preds, preds_orig
 
 
 def create_target_heatmap(target_landmarks, centers, scales):
     heatmaps = np.zeros((target_landmarks.shape[0], 68, 64, 64), dtype=np.float32)
-    for i in range(heatmaps.shape[0]):
-        for p in range(68):
-            landmark_cropped_coor = transform(target_landmarks[i, p] + 1, centers[i], scales[i], 64, invert=False)
-            heatmaps[i, p] = draw_gaussian(heatmaps[i, p], landmark_cropped_coor + 1, 1)
+    landmarks = torch.as_tensor(target_landmarks, dtype=torch.float32).view(-1, 68, 2)
+    landmarks_cropped_coor = transform_batch(landmarks + 1, centers, scales, 64, invert=False)
+    draw_gaussians(heatmaps, landmarks_cropped_coor.numpy() + 1, 1)
     return torch.tensor(heatmaps)
 
 
@@ -0,0 +1,48 @@
+import json
+import os
+import time
+
+DOWNLOADED = 'downloaded'
+ANALYSED = 'analysed'
+# a fragment finalized, "frame" is its last frame
+FRAGMENT = 'fragment'
+DONE = 'done'
+FAILED = 'failed'
+# not finished, the link is downloaded again on restart
+DOWNLOAD_FAILED = 'download_failed'
+
+
+def filename(output_dir=None):
+    return os.path.join(output_dir or "./output", "journal.jsonl")
+
+
+def record(journal_file, link, state, **data):
+    """Appends link state to journal_file, one JSON line per record, so
+    several processes may append to the same journal."""
+    data.update(link=link, state=state, time=time.time())
+    line = json.dumps(data) + "\n"
+    with open(journal_file, "a") as f:
+        f.write(line)
+
+
+def load(journal_file):
+    """Returns a dict of links to their records merged in order, "state" is
+    the last one. Missing journal is empty, an unfinished last line is skipped."""
+    links = {}
+    if not os.path.isfile(journal_file):
+        return links
+    with open(journal_file) as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            links.setdefault(data["link"], {}).update(data)
+    return links
+
+
+def resume_from(entry):
+    """Returns ff_frames and fragments already written for a journal entry."""
+    if "frame" in entry and entry.get("state") not in (DONE, FAILED):
+        return entry["frame"] + 1, entry.get("fragments", 0)
+    return 0, 0
@@ -1,11 +1,17 @@
 import argparse
 import logging
+import multiprocessing
 import os
 
 import check_frame
+import detect
+import journal
+import manifest
 import mlboard
 import process
+import scene
 import youtube
+from face_alignment.detection.sfd import backends as sfd_backends
 from log import init_logging
 
 
@@ -16,19 +22,73 @@ def main():
     parser.add_argument('--csv', type=str, default=None, help='Process several YouTube videos, link in CSV')
     parser.add_argument('--duration', type=int, default=None, help='Processed video duration in seconds, not crop if not set')
     parser.add_argument('--check-each-frame', type=int, default=1, help='Check each N frame for correct')
+    parser.add_argument('--refine-boundaries', action='store_true',
+                        help='Find fragment boundaries to a frame by bisecting frames between checked ones')
+    parser.add_argument('--analysis-decode', action='store_true',
+                        help='Check frames decoded by ffmpeg at the face detector size, '
+                             'decode full resolution frames only for encoded fragments')
+    parser.add_argument('--detect-batch-size', type=int, default=8, help='Check N sampled frames in one face detector run')
+    parser.add_argument('--queue-size', type=int, default=16, help='Frames queued between decode, check and write stages, 0 runs them serially')
+    parser.add_argument('--frame-buffer-mb', type=int, default=0,
+                        help='Decode frames into preallocated buffers taking at most N MB, 0 allocates each frame')
+    parser.add_argument('--finalize-workers', type=int, default=2,
+                        help='Join audio to and store encoded fragments in N background threads, 0 does it in place')
+    parser.add_argument('--extract-mode', type=str, default=process.ENCODE, choices=process.EXTRACT_MODES,
+                        help='Write fragments from decoded frames (encode) or cut them from the source with ffmpeg '
+                             'stream copy: from the keyframe before the fragment, so it may start with unchecked or '
+                             'rejected frames (copy), at keyframes inside the fragment (keyframe) or re-encoding '
+                             'partial GOPs at the ends (smart)')
+    parser.add_argument('--audio-batch-size', type=int, default=1,
+                        help='Join audio to N finished fragments in one ffmpeg run, 1 joins each fragment when finished. '
+                             'Fragments are stored and journaled when their batch is joined, up to N-1 waiting ones '
+                             'are lost on a crash')
+    parser.add_argument('--analyse-only', action='store_true',
+                        help='Only find fragments and store their frame ranges to manifests in output dir')
+    parser.add_argument('--extract', type=str, default=None,
+                        help='Write fragments from --analyse-only manifest or dir with manifests')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Process links by N worker processes, CPU threads are divided between them')
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='Download N next links in background while processing the current ones')
+    parser.add_argument('--prefetch-max-mb', type=int, default=None,
+                        help='Do not start prefetching while downloaded files take this many MB')
+    parser.add_argument('--journal', type=str, default=None,
+                        help='Progress journal, links finished in it are skipped, unfinished (or interrupted) ones '
+                             'resumed and failed downloads retried, output dir/journal.jsonl by default')
+    parser.add_argument('--track-full-every', type=int, default=1,
+                        help='Run the full face detector on each N checked frame only, verify the tracked face '
+                             'on a region around it in between. Faces appearing outside that region are not seen '
+                             'until the next full run, refine bisection always runs the full detector')
+    parser.add_argument('--track-iou-threshold', type=float, default=.5,
+                        help='Minimal IoU of the face found on the region with the tracked one')
     parser.add_argument('--output-dir', type=str, default=None, help='Output dir')
     parser.add_argument('--models-dir', type=str, default=None, help='Models dir')
     parser.add_argument('--face-detect-threshold', type=float, default=.5, help='Face detect threshold')
+    parser.add_argument('--detector-backend', type=str, default=sfd_backends.TORCH, choices=sfd_backends.BACKENDS,
+                        help='Run the face detector with torch, as frozen TorchScript or with ONNX Runtime (CPU), '
+                             'exported models are stored next to the weights in models dir')
+    parser.add_argument('--face-detect-quantized', action='store_true',
+                        help='Run the face detector INT8 quantized on CPU, the model is cached in models dir')
+    parser.add_argument('--face-detect-calibration-dir', type=str, default=None,
+                        help='Dir with frames to calibrate the quantized face detector on when it is not cached')
     parser.add_argument('--change-scene-threshold', type=float, default=.5, help='Change scene threshold')
+    parser.add_argument('--change-scene-metric', type=str, default=scene.SSIM, choices=scene.METRICS,
+                        help='Change scene metric: 1 - SSIM, histogram distance or mean absolute difference, '
+                             'threshold depends on it')
     args = parser.parse_args()
 
     init_logging()
 
-    if not args.link and not args.csv or args.link and args.csv:
-        raise RuntimeError("Should be only --youtube or only --csv parameter")
+    if sum(1 for a in (args.link, args.csv, args.extract) if a) != 1:
+        raise RuntimeError("Should be only --youtube, only --csv or only --extract parameter")
 
     links = []
-    if args.csv:
+    manifest_files = []
+    if args.extract:
+        for manifest_file in manifest.find(args.extract):
+            manifest_files.append(manifest_file)
+            links.append(manifest.read(manifest_file)["link"])
+    elif args.csv:
         with open(args.csv) as f:
             for link in f:
                 link = link.strip()
@@ -37,49 +97,177 @@ def main():
     else:
         links.append(args.link)
 
-    logging.info("Going to process {} YouTube links".format(len(links)))
+    total_count = len(links)
+    manifest_by_link = dict(zip(links, manifest_files))
 
-    check_frame.initialize(
-        models_dir=args.models_dir,
-        face_detect_threshold=args.face_detect_threshold,
-        change_scene_threshold=args.change_scene_threshold,
-    )
+    args.journal = args.journal or journal.filename(args.output_dir)
+    os.makedirs(os.path.dirname(args.journal) or ".", 0o755, exist_ok=True)
+    journaled = journal.load(args.journal)
+    finished = (journal.DONE, journal.FAILED)
+    if args.analyse_only:
+        finished += (journal.ANALYSED,)
+    skipped = {link for link in links if journaled.get(link, {}).get("state") in finished}
+    if skipped:
+        logging.info("Skip {} links finished in journal {}".format(len(skipped), args.journal))
+        links = [link for link in links if link not in skipped]
+
+    unique = youtube.unique_links(links)
+    if len(unique) < len(links):
+        logging.info("Skip {} links to videos linked before".format(len(links) - len(unique)))
+        links = unique
+
+    logging.info("Going to process {} YouTube links".format(len(links)))
 
-    total_fragments = 0
+    total_fragments = sum(journaled[link].get("fragments", 0) for link in skipped)
 
     mlboard.update_task_info({
-        "total.count": len(links),
+        "total.count": total_count,
     })
 
-    for n, link in enumerate(links):
-        mlboard.update_task_info({
-            "youtube.link": link,
-            "youtube.downloaded": "false",
-        })
-        video_file, audio_file = youtube.download(link)
-        mlboard.update_task_info({
-            "youtube.downloaded": "true",
-        })
-        fragments = process.process_video(
-            video_file, audio_file,
-            output_dir=args.output_dir,
-            duration=args.duration,
-            check_each_frame=args.check_each_frame,
-        )
+    prefetcher = youtube.Prefetcher(
+        links,
+        lookahead=args.prefetch,
+        consumers=max(1, args.workers),
+        max_bytes=args.prefetch_max_mb * 1024 * 1024 if args.prefetch_max_mb else None,
+    )
+
+    def jobs():
+        for link, video_file, audio_file, error in prefetcher:
+            mlboard.update_task_info({
+                "youtube.link": link,
+                "youtube.downloaded": "false" if error else "true",
+            })
+            ff_frames, fragments = journal.resume_from(journaled.get(link, {}))
+            yield (
+                link, manifest_by_link.get(link), video_file, audio_file,
+                str(error) if error else None, ff_frames, fragments,
+            )
+
+    pool = None
+    if args.workers > 1:
+        logging.info("Going to process links by {} workers".format(args.workers))
+        pool = multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(args,))
+        results = pool.imap_unordered(_process_link, jobs())
+    else:
+        _init_worker(args)
+        results = map(_process_link, jobs())
+
+    for n, (video_file, fragments) in enumerate(results):
+        if video_file is not None:
+            prefetcher.release(video_file)
         total_fragments += fragments
         mlboard.update_task_info({
             "total.fragments_done": total_fragments,
-            "total.processed": n + 1,
+            "total.processed": len(skipped) + n + 1,
         })
-        os.remove(video_file)
-        if audio_file != video_file:
-            os.remove(audio_file)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     mlboard.update_task_info({
         "youtube.processing": "-",
-        "youtube.processed": len(links),
+        "youtube.processed": total_count,
     })
 
 
+_args = None
+
+
+def _init_worker(args):
+    global _args
+    _args = args
+    if args.workers > 1:
+        detect.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+    if not args.extract:
+        check_frame.initialize(
+            models_dir=args.models_dir,
+            face_detect_threshold=args.face_detect_threshold,
+            change_scene_threshold=args.change_scene_threshold,
+            change_scene_metric=args.change_scene_metric,
+            track_full_every=args.track_full_every,
+            track_iou_threshold=args.track_iou_threshold,
+            face_detector_kwargs={
+                "backend": args.detector_backend,
+                "quantized": args.face_detect_quantized,
+                "calibration_dir": args.face_detect_calibration_dir,
+            },
+        )
+
+
+def _process_link(job):
+    link, manifest_file, video_file, audio_file, error, ff_frames, fragments_before = job
+    args = _args
+
+    if error is not None:
+        logging.error("Download {} error: {}".format(link, error))
+        journal.record(args.journal, link, journal.DOWNLOAD_FAILED, reason=error)
+        return None, 0
+
+    journal.record(args.journal, link, journal.DOWNLOADED)
+    if ff_frames:
+        logging.info("Resume {} from frame {}, {} fragments written".format(link, ff_frames, fragments_before))
+
+    def on_fragment(frame_idx, fragments):
+        journal.record(args.journal, link, journal.FRAGMENT, frame=frame_idx, fragments=fragments_before + fragments)
+
+    try:
+        if args.extract:
+            fragments = process.extract_video(
+                manifest_file, video_file, audio_file,
+                output_dir=args.output_dir,
+                extract_mode=args.extract_mode,
+                audio_batch_size=args.audio_batch_size,
+                ff_frames=ff_frames,
+                on_fragment=on_fragment,
+            )
+        else:
+            fragments = process.process_video(
+                video_file, audio_file,
+                output_dir=args.output_dir,
+                duration=args.duration,
+                ff_frames=0 if args.analyse_only else ff_frames,
+                check_each_frame=args.check_each_frame,
+                detect_batch_size=args.detect_batch_size,
+                queue_size=args.queue_size,
+                extract_mode=args.extract_mode,
+                audio_batch_size=args.audio_batch_size,
+                analyse_only=args.analyse_only,
+                manifest_info={"link": link},
+                on_fragment=on_fragment,
+                refine=args.refine_boundaries,
+                analysis_decode=args.analysis_decode,
+                frame_buffer_mb=args.frame_buffer_mb,
+                finalize_workers=args.finalize_workers,
+            )
+    except process.ProcessException as e:
+        logging.error("Process {} error: {}".format(link, e))
+        journal.record(args.journal, link, journal.FAILED, reason=str(e))
+        fragments = None
+    except KeyboardInterrupt:
+        # not done, the journal resumes it after its last stored fragment
+        logging.warning("Interrupted {}".format(link))
+        _remove_downloaded(video_file, audio_file)
+        raise
+
+    _remove_downloaded(video_file, audio_file)
+
+    if fragments is None:
+        return video_file, 0
+
+    if args.analyse_only:
+        journal.record(args.journal, link, journal.ANALYSED, ranges=fragments)
+        return video_file, fragments
+
+    journal.record(args.journal, link, journal.DONE, fragments=fragments_before + fragments)
+    return video_file, fragments
+
+
+def _remove_downloaded(video_file, audio_file):
+    os.remove(video_file)
+    if audio_file != video_file:
+        os.remove(audio_file)
+
+
 if __name__ == '__main__':
     main()
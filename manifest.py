@@ -0,0 +1,31 @@
+import glob
+import json
+import os
+
+
+def filename(video_file, output_dir):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(video_file))[0] + ".json")
+
+
+def video_id(video_file):
+    name = os.path.splitext(os.path.basename(video_file))[0]
+    return name[len("video-"):] if name.startswith("video-") else name
+
+
+def write(manifest_file, data):
+    temp_file = manifest_file + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_file, manifest_file)
+
+
+def read(manifest_file):
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def find(path):
+    """Returns manifest files, path is a manifest file or a dir with them."""
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.json")))
+    return [path]
@@ -1,4 +1,8 @@
 import logging
+import multiprocessing.util
+import os
+import threading
+import time
 
 try:
     from mlboardclient.api import client
@@ -8,11 +12,13 @@ except ImportError:
 mlboard = None
 mlboard_tried = False
 
+reporter = None
+
 
 def get():
-    if client is None:
-        return None
     global mlboard, mlboard_tried
+    if client is None and not mlboard_tried:
+        return None
     if not mlboard_tried:
         mlboard_tried = True
         mlboard = client.Client()
@@ -26,8 +32,100 @@ def get():
     return mlboard
 
 
+def use_client(c):
+    """Reports to c instead of the mlboard client, e.g. to a LocalClient."""
+    global mlboard, mlboard_tried, reporter
+    if reporter is not None:
+        reporter.close()
+        reporter = None
+    mlboard, mlboard_tried = c, True
+
+
+class LocalClient(object):
+    """Stub of the mlboard client keeping updates in memory and logging them."""
+
+    def __init__(self):
+        self.updates = []
+
+    def update_task_info(self, data, app_name=None, task_name=None, build_id=None, fail_on_error=False):
+        logging.debug("mlboard update: %s" % data)
+        self.updates.append(dict(data))
+
+
+class Reporter(object):
+    """Sends update_task_info data to client from a background thread.
+    Updates are merged to the latest value of each key and sent each
+    interval seconds, or as soon as batch_size keys wait. While a send is
+    slow new updates keep merging, so at most one value of a key waits.
+    close() sends what is left."""
+
+    def __init__(self, client, interval=5., batch_size=64):
+        self.client = client
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        # (app_name, task_name, build_id) to data waiting for them
+        self._pending = {}
+        self._waiting = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, data, app_name=None, task_name=None, build_id=None):
+        with self._condition:
+            pending = self._pending.setdefault((app_name, task_name, build_id), {})
+            self._waiting -= len(pending)
+            pending.update(data)
+            self._waiting += len(pending)
+            if self._waiting >= self.batch_size:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                deadline = time.time() + self.interval
+                while not self._closed and self._waiting < self.batch_size and time.time() < deadline:
+                    self._condition.wait(deadline - time.time())
+                pending, self._pending, self._waiting = self._pending, {}, 0
+                closed = self._closed
+            self._send(pending)
+            if closed:
+                break
+
+    def _send(self, pending):
+        for (app_name, task_name, build_id), data in pending.items():
+            try:
+                self.client.update_task_info(data, app_name, task_name, build_id)
+            except Exception as e:
+                logging.warning("mlboard update failed: %s" % e)
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+
+def _get_reporter(m):
+    global reporter
+    # a reporter inherited by a forked worker has no thread
+    if reporter is None or reporter.pid != os.getpid():
+        reporter = Reporter(m)
+        multiprocessing.util.Finalize(reporter, reporter.close, exitpriority=10)
+    return reporter
+
+
 def update_task_info(data, app_name=None,
                          task_name=None, build_id=None, fail_on_error=False):
+    """Reports data in the background (see Reporter), with fail_on_error
+    it is sent at once and errors are raised."""
     m = get()
-    if m is not None:
-        m.update_task_info(data, app_name, task_name, build_id, fail_on_error)
\ No newline at end of file
+    if m is None:
+        return
+    if fail_on_error:
+        m.update_task_info(data, app_name, task_name, build_id, fail_on_error)
+    else:
+        _get_reporter(m).update(data, app_name, task_name, build_id)
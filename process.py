@@ -1,13 +1,21 @@
+import collections
+import concurrent.futures
 import logging
 import os
+import queue
 import shutil
 import tempfile
 import threading
 
 import cv2
+import numpy as np
 
 import audio
 import check_frame
+import cut
+import decode
+import detect
+import manifest
 import mlboard
 
 
@@ -15,13 +23,48 @@ class ProcessException(Exception):
     pass
 
 
+# encode decoded frames with cv2.VideoWriter, other modes are cut.MODES
+ENCODE = 'encode'
+EXTRACT_MODES = (ENCODE,) + cut.MODES
+
+
 def _out_video_filename(video_filename, frame_idx, duration=None):
     ext = os.path.splitext(os.path.basename(video_filename))
     d = "" if duration is None else "-{}s".format(duration)
     return "{}-{}{}{}".format(ext[0], frame_idx, d, ext[1])
 
 
-def process_video(video_file, audio_file=None, output_dir=None, duration=None, ff_frames=0, check_each_frame=1):
+def _fourcc(cap):
+    # from facenet
+    ex = int(cap.get(cv2.CAP_PROP_FOURCC))
+    codec = (
+            chr(ex & 0xFF) +
+            chr((ex & 0xFF00) >> 8) +
+            chr((ex & 0xFF0000) >> 16) +
+            chr((ex & 0xFF000000) >> 24)
+    )
+    return cv2.VideoWriter_fourcc(*codec)
+
+
+def process_video(video_file, audio_file=None, output_dir=None, duration=None, ff_frames=0, check_each_frame=1,
+                  detect_batch_size=8, queue_size=0, extract_mode=ENCODE,
+                  audio_batch_size=1, analyse_only=False, manifest_info=None, on_fragment=None,
+                  refine=False, analysis_decode=False, frame_buffer_mb=0, finalize_workers=0):
+    """Finds fragments with one face and no scene changes and writes them
+    to output_dir. With analyse_only nothing is written but a manifest of
+    accepted frame ranges (see ManifestWriter), extract_video cuts them later.
+    on_fragment(frame_idx, fragments) is called for each stored fragment
+    with its last frame, process_video may be resumed with ff_frames after it.
+    With refine fragment boundaries are found to a frame between frames
+    checked each check_each_frame (see _check_frames).
+    With analysis_decode checks run on frames decoded by ffmpeg already
+    scaled to the face detector input (see decode.read_scaled), encoded
+    fragments are decoded again at full resolution only for their frames.
+    With frame_buffer_mb decoded frames are read into a FramePool of
+    preallocated buffers taking at most that many MB. With finalize_workers
+    encoded fragments are finalized in the background (see FinalizePool).
+    Returns the number of fragments, or of accepted ranges with analyse_only.
+    KeyboardInterrupt is raised again once stored fragments are counted."""
     cap = cv2.VideoCapture(video_file)
     frame_idx = -1
 
@@ -33,16 +76,7 @@ def process_video(video_file, audio_file=None, output_dir=None, duration=None, f
     video_duration = n_frames / fps
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-    # from facenet
-    ex = int(cap.get(cv2.CAP_PROP_FOURCC))
-    codec = (
-            chr(ex & 0xFF) +
-            chr((ex & 0xFF00) >> 8) +
-            chr((ex & 0xFF0000) >> 16) +
-            chr((ex & 0xFF000000) >> 24)
-    )
-    fourcc = cv2.VideoWriter_fourcc(*codec)
+    fourcc = _fourcc(cap)
 
     if duration is not None and video_duration < duration:
         raise ProcessException("Source video's length {} seconds "
@@ -53,133 +87,911 @@ def process_video(video_file, audio_file=None, output_dir=None, duration=None, f
     if output_dir is None:
         output_dir = "./output"
     if not os.path.isdir(output_dir):
-        os.makedirs(output_dir, 0o755)
+        os.makedirs(output_dir, 0o755, exist_ok=True)
 
     temp_dir = tempfile.gettempdir()
 
+    # frames are not needed unless they are encoded
+    sparse = (analyse_only or extract_mode != ENCODE or analysis_decode) and not refine
+
+    pool = None
+    if frame_buffer_mb and not analysis_decode:
+        # frames held by the check stage and not yet flushed to the writer
+        min_frames = detect_batch_size * check_each_frame + check_each_frame + 1
+        pool_frames = int(frame_buffer_mb * 2 ** 20 // (width * height * 3))
+        if pool_frames < min_frames:
+            safe_run(cap.release)
+            raise ProcessException("Frame buffer of {} MB holds {} frames of {}x{}, "
+                                   "at least {} are needed".format(frame_buffer_mb, pool_frames, width, height,
+                                                                   min_frames))
+        pool = FramePool((height, width, 3), pool_frames)
+    if analysis_decode:
+        try:
+            decoded = decode.read_scaled(
+                video_file, *detect.DETECTOR_SIZE, first_frame=frame_idx + 1,
+                every=check_each_frame if sparse else 1, n_frames=n_frames,
+            )
+        except decode.DecodeException as e:
+            safe_run(cap.release)
+            raise ProcessException(str(e))
+    else:
+        decoded = _read_frames(cap, frame_idx, check_each_frame=check_each_frame, sparse=sparse, pool=pool)
+
+    if analyse_only:
+        info = {
+            "video_id": manifest.video_id(video_file),
+            "video_file": os.path.basename(video_file),
+            "audio_file": os.path.basename(audio_file) if audio_file else None,
+            "fps": fps,
+            "frames": n_frames,
+            "duration": duration,
+        }
+        info.update(manifest_info or {})
+        writer = ManifestWriter(manifest.filename(video_file, output_dir), info, ff_frames, n_frames)
+    elif extract_mode == ENCODE:
+        writer = FragmentWriter(fourcc, fps, (width, height), audio_file, audio_batch_size=audio_batch_size,
+                                on_fragment=on_fragment, source_file=video_file if analysis_decode else None,
+                                finalize_workers=finalize_workers)
+    else:
+        writer = StreamCopyFragmentWriter(video_file, fps, audio_file, mode=extract_mode, on_fragment=on_fragment)
+    if queue_size and not analyse_only:
+        writer = ThreadedFragmentWriter(writer, queue_size, on_written=pool.release_all if pool is not None else None)
+
     video_part_file = None
-    final_file = None
     video_part_start = None
-    video_writer = None
-    previous_frame = None
 
-    fragments = 0
     frames_to_write = []
-    frames_written = 0
 
+    def write(frames):
+        writer.write(frames)
+        if pool is not None and not isinstance(writer, ThreadedFragmentWriter):
+            pool.release_all(frames)
+
+    if queue_size:
+        decoded = _threaded(decoded, queue_size)
+
+    frames = _check_frames(
+        decoded,
+        check_each_frame=check_each_frame,
+        batch_size=detect_batch_size,
+        refine=refine,
+        pool=pool,
+    )
+
+    decode_error = None
+    interrupted = False
+    closed = False
     try:
+        try:
+            for frame_idx, frame, checked, error in frames:
 
-        while cap.isOpened():
-            success, frame = cap.read()
+                frames_to_write.append(frame)
+
+                if frame_idx % 100 == 0:
+                    mlboard.update_task_info({
+                        "process.frames_processed": frame_idx,
+                        "youtube.frames": n_frames,
+                    })
+
+                # with refine frames between checked ones are correct when the
+                # one before them is (see _check_frames), duration fragments
+                # finish on them as with each frame checked
+                due = duration is not None \
+                    and video_part_start is not None \
+                    and frame_idx - video_part_start >= duration * fps
+                if not checked and not (refine and due):
+                    continue
+
+                finish_recording = False
+                interrupt_recording = False
+                interrupt_recording_reason = None
+
+                if error is None:
+                    frame_is_correct = True
+                    if due:
+                        finish_recording = True
+
+                else:
+                    frame_is_correct = False
+                    if pool is not None:
+                        pool.release_all(frames_to_write)
+                    frames_to_write = []
+                    if duration is not None:
+                        interrupt_recording = True
+                        interrupt_recording_reason = str(error)
+                    else:
+                        finish_recording = True
+
+                if interrupt_recording:
+
+                    if video_part_file is not None:
+                        logging.warning("Interrupt video fragment {} on frame {} because {}".format(
+                            video_part_file, frame_idx, interrupt_recording_reason))
+                        writer.interrupt()
+                        video_part_start = None
+                        video_part_file = None
+
+                elif finish_recording:
+
+                    if video_part_file is not None:
+
+                        write(frames_to_write)
+                        frames_to_write = []
+
+                        writer.finish(frame_idx)
+
+                        video_part_start = None
+                        video_part_file = None
+
+                elif frame_is_correct:
+
+                    if video_part_file is None:
+                        video_part_start = frame_idx
+                        ovf = _out_video_filename(video_file, video_part_start, duration)
+                        video_part_file = os.path.join(temp_dir, ovf)
+                        writer.start(video_part_file, os.path.join(output_dir, ovf), video_part_start)
+                        if pool is not None:
+                            pool.release_all(frames_to_write)
+                        frames_to_write = []
+
+                    write(frames_to_write)
+                    frames_to_write = []
+
+                if error is not None:
+                    writer.reject(frame_idx, str(error))
+
+        except KeyboardInterrupt:
+            logging.warning("Keyboard interrupt")
+            interrupted = True
+        except decode.DecodeException as e:
+            decode_error = e
+        finally:
+            # frames held by the checks are released first, then the decoder
+            # blocked on a full pool is woken up to stop
+            frames.close()
+            if pool is not None:
+                pool.release_all(frames_to_write)
+                pool.close()
+            decoded.close()
+
+        if video_part_file is not None:
+            if duration is None and decode_error is None and not interrupted:
+                writer.finish(frame_idx)
+            else:
+                logging.warning("Interrupt tailing video fragment {}".format(video_part_file))
+                writer.interrupt()
+
+        if interrupted and analyse_only:
+            # a manifest of the frames analysed so far would look complete
+            writer.abort()
+        else:
+            fragments = writer.close()
+        closed = True
+    finally:
+        if not closed:
+            writer.abort()
+        safe_run(cap.release)
+
+    if decode_error is not None:
+        raise ProcessException(str(decode_error))
+    if interrupted:
+        # stored fragments are counted, the video is resumed after them
+        raise KeyboardInterrupt
+
+    return fragments
+
+
+class FragmentWriter(object):
+    """Encodes fragment frames with cv2.VideoWriter, joins audio and moves
+    finished fragments to the output dir. With audio_batch_size > 1 finished
+    fragments wait until that many of them are joined with audio at once.
+    on_fragment(frame_idx, fragments) is called for each stored fragment.
+    With source_file written frames are only counted, the same frames are
+    decoded from it at full resolution (e.g. when checks run on frames
+    from decode.read_scaled). With finalize_workers finished fragments are
+    finalized in a FinalizePool, stored ones are counted (and on_fragment
+    called) in the order they were finished, at latest by close()."""
+
+    # gaps up to it are skipped by grabbing frames instead of seeking
+    max_grab = 250
+
+    def __init__(self, fourcc, fps, frame_size, audio_file=None, audio_batch_size=1, on_fragment=None,
+                 source_file=None, finalize_workers=0):
+        self.fourcc = fourcc
+        self.fps = fps
+        self.frame_size = frame_size
+        self.audio_file = audio_file
+        self.audio_batch_size = audio_batch_size
+        self.on_fragment = on_fragment
+        self.source_file = source_file
+        self.fragments = 0
+        self._pending = []
+        self._source_cap = None
+        self._source_idx = 0
+        self._finalize_pool = None
+        if finalize_workers:
+            self._finalize_pool = FinalizePool(finalize_workers, backlog=2 * finalize_workers)
+        self._reset()
+
+    def _reset(self):
+        self._video_writer = None
+        self._video_part_file = None
+        self._final_file = None
+        self._video_part_start = None
+        self._frames_written = 0
+
+    def start(self, video_part_file, final_file, video_part_start):
+        if os.path.exists(video_part_file):
+            os.remove(video_part_file)
+        logging.info("Start video fragment {} from frame {}".format(
+            video_part_file, video_part_start))
+        self._video_writer = cv2.VideoWriter(
+            video_part_file, self.fourcc, self.fps,
+            frameSize=self.frame_size
+        )
+        self._video_part_file = video_part_file
+        self._final_file = final_file
+        self._video_part_start = video_part_start
+        self._frames_written = 0
+        if self.source_file is not None:
+            self._seek_source(video_part_start + 1)
+
+    def _seek_source(self, frame_idx):
+        if self._source_cap is None:
+            self._source_cap = cv2.VideoCapture(self.source_file)
+            self._source_idx = 0
+        if 0 <= frame_idx - self._source_idx <= self.max_grab:
+            while self._source_idx < frame_idx and self._source_cap.grab():
+                self._source_idx += 1
+        else:
+            self._source_cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+            self._source_idx = frame_idx
+
+    def _read_source(self, count):
+        frames = []
+        for _ in range(count):
+            success, frame = self._source_cap.read()
             if not success:
                 break
+            frames.append(frame)
+        self._source_idx += len(frames)
+        return frames
 
-            frame_idx += 1
+    def write(self, frames):
+        if self.source_file is not None:
+            frames = self._read_source(len(frames))
+        self._frames_written += flush_video(self._video_writer, frames)
+
+    def finish(self, frame_idx):
+        if self.audio_file and self.audio_batch_size > 1:
+            logging.info("Finish video fragment {}: {}-{}, frames written {}".format(
+                self._video_part_file, self._video_part_start, frame_idx, self._frames_written))
+            safe_run(self._video_writer.release)
+            self._pending.append((self._video_part_file, self._final_file, self._video_part_start, frame_idx))
+            if len(self._pending) >= self.audio_batch_size:
+                self._flush_pending()
+        else:
+            self._finalize(
+                self._finalize_one, self._video_writer, self._video_part_file, self._frames_written,
+                self._video_part_start, frame_idx, self._final_file,
+            )
+        self._reset()
 
-            frames_to_write.append(frame)
+    def _stored(self, frame_idx, fragments):
+        self.fragments = fragments
+        if self.on_fragment is not None:
+            self.on_fragment(frame_idx, fragments)
 
-            if frame_idx % 100 == 0:
-                mlboard.update_task_info({
-                    "process.frames_processed": frame_idx,
-                    "youtube.frames": n_frames,
-                })
+    def _finalize(self, job, *args):
+        # job returns last frames of the fragments it stored
+        if self._finalize_pool is None:
+            self._count_stored(job(*args))
+        else:
+            self._finalize_pool.submit(job, *args)
+            self._collect()
+
+    def _collect(self, wait=False):
+        for future in self._finalize_pool.completed(wait=wait):
+            self._count_stored(future.result())
+
+    def _count_stored(self, stored):
+        for frame_idx in stored:
+            self._stored(frame_idx, count_fragment(self.fragments))
 
-            if frame_idx % check_each_frame > 0:
+    def _finalize_one(self, video_writer, video_part_file, frames_written, video_part_start, frame_idx, final_file):
+        stored = _finalize_video_file(
+            video_writer, video_part_file, self.audio_file, frames_written,
+            video_part_start, frame_idx, self.fps, final_file,
+        )
+        return [frame_idx] if stored else []
+
+    def _flush_pending(self):
+        pending, self._pending = self._pending, []
+        self._finalize(self._join_audio_batch, pending)
+
+    def _join_audio_batch(self, pending):
+        errors = audio.apply_audio_batch(
+            [(video_part_file, start / self.fps, end / self.fps) for video_part_file, _, start, end in pending],
+            self.audio_file,
+        )
+        stored = []
+        for (video_part_file, final_file, start, end), error in zip(pending, errors):
+            if error is not None:
+                os.remove(video_part_file)
+                logging.error("Join with audio error: %s, file %s removed" % (str(error), video_part_file))
                 continue
+            logging.info("Audio joined to fragment %s: %s-%s, %s-%s sec" % (
+                video_part_file, start, end, start / self.fps, end / self.fps,
+            ))
+            move_fragment(video_part_file, final_file)
+            stored.append(end)
+        return stored
+
+    def interrupt(self):
+        safe_run(self._video_writer.release)
+        if os.path.exists(self._video_part_file):
+            os.remove(self._video_part_file)
+        self._reset()
 
-            finish_recording = False
-            interrupt_recording = False
-            interrupt_recording_reason = None
+    def reject(self, frame_idx, reason):
+        pass
 
+    def abort(self):
+        """Drops the fragment being written and the ones waiting for audio,
+        when processing failed and close() is not called. Fragments already
+        being finalized are waited for and counted, failed ones are logged."""
+        if self._video_writer is not None:
+            self.interrupt()
+        pending, self._pending = self._pending, []
+        for video_part_file, _, _, _ in pending:
+            if os.path.exists(video_part_file):
+                os.remove(video_part_file)
+        if self._finalize_pool is not None:
             try:
-                check_frame.is_correct(frame, previous_frame)
-                frame_is_correct = True
-                if duration is not None \
-                        and video_part_start is not None \
-                        and frame_idx - video_part_start >= duration * fps:
-                    finish_recording = True
-
-            except check_frame.CheckFrameException as e:
-                frame_is_correct = False
-                frames_to_write = []
-                if duration is not None:
-                    interrupt_recording = True
-                    interrupt_recording_reason = str(e)
-                else:
-                    finish_recording = True
+                for future in self._finalize_pool.completed(wait=True):
+                    if future.exception() is not None:
+                        logging.error("Finalize fragment error: %s" % str(future.exception()))
+                    else:
+                        self._count_stored(future.result())
+            finally:
+                self._finalize_pool.shutdown()
+        if self._source_cap is not None:
+            safe_run(self._source_cap.release)
+            self._source_cap = None
 
-            if interrupt_recording:
+    def close(self):
+        if self._pending:
+            self._flush_pending()
+        if self._finalize_pool is not None:
+            try:
+                self._collect(wait=True)
+            finally:
+                self._finalize_pool.shutdown()
+        if self._source_cap is not None:
+            safe_run(self._source_cap.release)
+        return self.fragments
 
-                if video_writer is not None:
-                    logging.warning("Interrupt video fragment {} on frame {} because {}".format(
-                        video_part_file, frame_idx, interrupt_recording_reason))
-                    safe_run(video_writer.release)
-                    video_writer = None
-                    video_part_start = None
 
-                    if os.path.exists(video_part_file):
-                        os.remove(video_part_file)
-                    video_part_file = None
+class FinalizePool(object):
+    """Runs fragment finalization jobs on workers threads. At most backlog
+    jobs are unfinished, submit waits for the oldest one otherwise."""
 
-            elif finish_recording:
+    def __init__(self, workers=2, backlog=4):
+        self.backlog = backlog
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._futures = collections.deque()
 
-                if video_writer is not None:
+    def submit(self, job, *args):
+        if len(self._futures) >= self.backlog:
+            concurrent.futures.wait([self._futures[0]])
+        future = self._executor.submit(job, *args)
+        self._futures.append(future)
+        return future
 
-                    frames_written += flush_video(video_writer, frames_to_write)
-                    frames_to_write = []
+    def completed(self, wait=False):
+        """Returns futures of finished jobs in submit order up to the first
+        unfinished one, with wait of all jobs after they finish."""
+        futures = []
+        while self._futures and (wait or self._futures[0].done()):
+            future = self._futures.popleft()
+            concurrent.futures.wait([future])
+            futures.append(future)
+        return futures
 
-                    fragments = finalize_video(
-                        video_writer, video_part_file, audio_file, frames_written,
-                        video_part_start, frame_idx, fps, final_file, fragments,
-                    )
-
-                    video_writer = None
-                    video_part_start = None
-                    video_part_file = None
-
-            elif frame_is_correct:
-
-                if video_part_file is None:
-                    video_part_start = frame_idx
-                    ovf = _out_video_filename(video_file, video_part_start, duration)
-                    video_part_file = os.path.join(temp_dir, ovf)
-                    final_file = os.path.join(output_dir, ovf)
-                    if os.path.exists(video_part_file):
-                        os.remove(video_part_file)
-                    logging.info("Start video fragment {} from frame {}".format(
-                        video_part_file, video_part_start))
-                    video_writer = cv2.VideoWriter(
-                        video_part_file, fourcc, fps,
-                        frameSize=(width, height)
-                    )
-                    frames_written = 0
-                    frames_to_write = []
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
 
-                frames_written += flush_video(video_writer, frames_to_write)
-                frames_to_write = []
 
-            previous_frame = frame
+class StreamCopyFragmentWriter(object):
+    """Cuts finished fragments out of the source video with ffmpeg (see
+    cut.cut_fragment) instead of encoding decoded frames, written frames
+    are ignored. on_fragment is called as by FragmentWriter."""
 
-    except KeyboardInterrupt:
-        logging.warning("Keyboard interrupt")
+    def __init__(self, video_file, fps, audio_file=None, mode=cut.COPY, on_fragment=None):
+        self.video_file = video_file
+        self.fps = fps
+        self.audio_file = audio_file
+        self.mode = mode
+        self.on_fragment = on_fragment
+        self.fragments = 0
+        self._keyframes = None
+        self._reset()
 
-    if video_writer is not None:
-        if duration is None:
-            fragments = finalize_video(
-                video_writer, video_part_file, audio_file, frames_written,
-                video_part_start, frame_idx, fps, final_file, fragments,
+    def _reset(self):
+        self._video_part_file = None
+        self._final_file = None
+        self._video_part_start = None
+
+    def start(self, video_part_file, final_file, video_part_start):
+        logging.info("Start video fragment {} from frame {}".format(
+            video_part_file, video_part_start))
+        self._video_part_file = video_part_file
+        self._final_file = final_file
+        self._video_part_start = video_part_start
+
+    def write(self, frames):
+        pass
+
+    def finish(self, frame_idx):
+        logging.info("Finish video fragment {}: {}-{}".format(
+            self._video_part_file, self._video_part_start, frame_idx))
+
+        try:
+            if self._keyframes is None and self.mode != cut.COPY:
+                self._keyframes = cut.keyframe_times(self.video_file)
+            start, end = cut.cut_fragment(
+                self.video_file, self._video_part_file,
+                self._video_part_start / self.fps, frame_idx / self.fps,
+                audio_file=self.audio_file, mode=self.mode, keyframes=self._keyframes,
             )
+            logging.info("Fragment %s cut: %s-%s sec" % (self._video_part_file, start, end))
+        except cut.CutException as e:
+            if os.path.exists(self._video_part_file):
+                os.remove(self._video_part_file)
+            logging.error("Cut fragment error: %s, fragment %s dropped" % (str(e), self._video_part_file))
         else:
-            logging.warning("Interrupt tailing video fragment {}".format(video_part_file))
-            safe_run(video_writer.release)
-            if os.path.exists(video_part_file):
-                os.remove(video_part_file)
+            self.fragments = store_fragment(self._video_part_file, self._final_file, self.fragments)
+            if self.on_fragment is not None:
+                self.on_fragment(frame_idx, self.fragments)
+
+        self._reset()
+
+    def interrupt(self):
+        self._reset()
+
+    def reject(self, frame_idx, reason):
+        pass
+
+    def abort(self):
+        self._reset()
+
+    def close(self):
+        return self.fragments
+
+
+class ManifestWriter(object):
+    """Writes no fragments, only records them to manifest_file: "ranges" of
+    accepted [start, end, last] frames and "gaps" of [start, end, reason]
+    between them, reason is of the first rejected frame in a gap, null if
+    there were none (split by duration). A fragment is finished on frame end
+    but holds frames start + 1 to last, the frames process_video writes:
+    end is the rejected frame when it is not split by duration."""
+
+    def __init__(self, manifest_file, info, first_frame=0, n_frames=0):
+        self.manifest_file = manifest_file
+        self.info = info
+        self.n_frames = n_frames
+        self.ranges = []
+        self.gaps = []
+        self._gap_start = first_frame
+        self._gap_reason = None
+        self._video_part_start = None
+        self._frames_written = 0
+
+    def _add_gap(self, end):
+        if end > self._gap_start:
+            self.gaps.append([self._gap_start, end, self._gap_reason])
+
+    def start(self, video_part_file, final_file, video_part_start):
+        self._video_part_start = video_part_start
+        self._frames_written = 0
+
+    def write(self, frames):
+        self._frames_written += len(frames)
+
+    def finish(self, frame_idx):
+        self._add_gap(self._video_part_start)
+        self.ranges.append([self._video_part_start, frame_idx, self._video_part_start + self._frames_written])
+        self._gap_start = frame_idx
+        self._gap_reason = None
+        self._video_part_start = None
+
+    def interrupt(self):
+        self._video_part_start = None
+
+    def reject(self, frame_idx, reason):
+        if self._gap_reason is None:
+            self._gap_reason = reason
+
+    def abort(self):
+        # an incomplete manifest is not written
+        self._video_part_start = None
+
+    def close(self):
+        self._add_gap(self.n_frames)
+        data = dict(self.info)
+        data["ranges"] = self.ranges
+        data["gaps"] = self.gaps
+        manifest.write(self.manifest_file, data)
+        logging.info("Manifest stored to {}: {} ranges".format(self.manifest_file, len(self.ranges)))
+        return len(self.ranges)
+
+
+class ThreadedFragmentWriter(object):
+    """Runs FragmentWriter calls in a background thread. At most queue_size
+    frames and commands wait for it, callers block when the queue is full.
+    on_written(frames) is called in the thread after frames are written.
+    An error of a call is raised by the next one, the writer is aborted then."""
+
+    def __init__(self, writer, queue_size, on_written=None):
+        self._writer = writer
+        self._on_written = on_written
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._aborted = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            method, args = self._queue.get()
+            if method is None:
+                break
+            if self._error is None and not self._aborted:
+                try:
+                    getattr(self._writer, method)(*args)
+                except Exception as e:
+                    self._error = e
+            if method == 'write' and self._on_written is not None:
+                self._on_written(args[0])
+
+    def _put(self, method, *args):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((method, args))
+
+    def start(self, video_part_file, final_file, video_part_start):
+        self._put('start', video_part_file, final_file, video_part_start)
+
+    def write(self, frames):
+        for frame in frames:
+            self._put('write', [frame])
+
+    def finish(self, frame_idx):
+        self._put('finish', frame_idx)
+
+    def interrupt(self):
+        self._put('interrupt')
+
+    def reject(self, frame_idx, reason):
+        self._put('reject', frame_idx, reason)
+
+    def abort(self):
+        # queued calls are skipped, frames are still passed to on_written
+        self._aborted = True
+        if self._thread.is_alive():
+            self._queue.put((None, None))
+            self._thread.join()
+        self._writer.abort()
+
+    def close(self):
+        self._queue.put((None, None))
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._writer.close()
+
+
+def _threaded(iterable, queue_size):
+    """Iterates iterable in a background thread and yields its items through
+    a queue of queue_size items."""
+    q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = q.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def extract_video(manifest_file, video_file, audio_file=None, output_dir=None, extract_mode=ENCODE,
+                  audio_batch_size=1, ff_frames=0, on_fragment=None):
+    """Writes fragments of accepted frame ranges from a process_video
+    analyse_only manifest, skipping ranges starting before ff_frames.
+    on_fragment is called as by process_video. Returns the number of fragments,
+    KeyboardInterrupt is raised again once stored fragments are counted."""
+    data = manifest.read(manifest_file)
+    fps = data["fps"]
+
+    if output_dir is None:
+        output_dir = "./output"
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir, 0o755, exist_ok=True)
+
+    temp_dir = tempfile.gettempdir()
+
+    cap = None
+    if extract_mode == ENCODE:
+        cap = cv2.VideoCapture(video_file)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        writer = FragmentWriter(_fourcc(cap), fps, (width, height), audio_file, audio_batch_size=audio_batch_size,
+                                on_fragment=on_fragment)
+    else:
+        writer = StreamCopyFragmentWriter(video_file, fps, audio_file, mode=extract_mode, on_fragment=on_fragment)
 
-    safe_run(cap.release)
+    # manifests without the last written frame hold [start, end] ranges
+    ranges = [(r[0], r[1], r[2] if len(r) > 2 else r[1]) for r in data["ranges"] if r[0] >= ff_frames]
+    logging.info("Extract {} fragments of {}".format(len(ranges), video_file))
+
+    interrupted = False
+    started = False
+    try:
+        for start, end, last in ranges:
+            ovf = _out_video_filename(video_file, start, data["duration"])
+            writer.start(os.path.join(temp_dir, ovf), os.path.join(output_dir, ovf), start)
+            started = True
+            if cap is not None:
+                # process_video writes frames after the first checked one
+                cap.set(cv2.CAP_PROP_POS_FRAMES, start + 1)
+                for _ in range(last - start):
+                    success, frame = cap.read()
+                    if not success:
+                        break
+                    writer.write([frame])
+            writer.finish(end)
+            started = False
+    except KeyboardInterrupt:
+        logging.warning("Keyboard interrupt")
+        interrupted = True
+        if started:
+            writer.interrupt()
+
+    fragments = writer.close()
+
+    if cap is not None:
+        safe_run(cap.release)
+
+    if interrupted:
+        raise KeyboardInterrupt
 
     return fragments
 
 
+class FramePool(object):
+    """Preallocated buffers for count frames of shape. acquire() takes a
+    free one, blocking while all are held, retain() adds a holder of a
+    frame and release() drops one, the buffer is free without holders.
+    Frames not from the pool (and None) are ignored by retain and release.
+    After close() acquire returns None instead of blocking."""
+
+    def __init__(self, shape, count):
+        self._buffers = {}
+        self._holders = {}
+        self._free = []
+        for _ in range(count):
+            buffer = np.empty(shape, dtype=np.uint8)
+            self._buffers[id(buffer)] = buffer
+            self._free.append(buffer)
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while not self._free and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return None
+            buffer = self._free.pop()
+            self._holders[id(buffer)] = 1
+            return buffer
+
+    def retain(self, frame):
+        if frame is None or id(frame) not in self._buffers:
+            return
+        with self._condition:
+            self._holders[id(frame)] += 1
+
+    def release(self, frame):
+        if frame is None or id(frame) not in self._buffers:
+            return
+        with self._condition:
+            self._holders[id(frame)] -= 1
+            if self._holders[id(frame)] == 0:
+                self._free.append(frame)
+                self._condition.notify()
+
+    def release_all(self, frames):
+        for frame in frames:
+            self.release(frame)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+def _read_frames(cap, frame_idx=-1, check_each_frame=1, sparse=False, pool=None):
+    """Yields (frame_idx, frame), with sparse frames which are not checked
+    are only grabbed and yielded as None. With pool frames are read into
+    its buffers, they are released by whoever drops them last."""
+    while cap.isOpened():
+        if sparse and (frame_idx + 1) % check_each_frame > 0:
+            if not cap.grab():
+                break
+            frame_idx += 1
+            yield frame_idx, None
+            continue
+        if pool is not None:
+            buffer = pool.acquire()
+            if buffer is None:
+                break
+            success, frame = cap.read(image=buffer)
+            if frame is not buffer:
+                pool.release(buffer)
+        else:
+            success, frame = cap.read()
+        if not success:
+            break
+        frame_idx += 1
+        yield frame_idx, frame
+
+
+def _check_frames(frames, check_each_frame=1, batch_size=1, refine=False, pool=None):
+    """Yields (frame_idx, frame, checked, error) in source order. Each
+    check_each_frame frame is checked, checks run in batches of batch_size
+    frames, so up to batch_size * check_each_frame frames are held back.
+    With refine, where the result changes between two checked frames the
+    frames in between are bisected to check the boundary frames too.
+    The last checked frame is retained in pool while the next are checked
+    against it, yielded frames are left to the caller to release, frames
+    not yielded yet are released when the generator is closed."""
+    previous = None
+    pending = []
+    # pending items yielded
+    done = 0
+    to_check = 0
+    try:
+        for frame_idx, frame in frames:
+            checked = frame_idx % check_each_frame == 0
+            pending.append([frame_idx, frame, checked, None])
+            if checked:
+                to_check += 1
+            if to_check >= batch_size:
+                last = _check_pending(pending, previous, refine)
+                if pool is not None and last is not previous:
+                    pool.retain(last[1])
+                    if previous is not None:
+                        pool.release(previous[1])
+                previous = last
+                for item in pending:
+                    done += 1
+                    yield tuple(item)
+                pending = []
+                done = 0
+                to_check = 0
+        _check_pending(pending, previous, refine)
+        for item in pending:
+            done += 1
+            yield tuple(item)
+    finally:
+        if pool is not None:
+            pool.release_all(item[1] for item in pending[done:])
+            if previous is not None:
+                pool.release(previous[1])
+
+
+def _check_pending(pending, previous=None, refine=False):
+    """Checks pending [frame_idx, frame, checked, error] items in place,
+    previous is the last checked item before them. Returns the last
+    checked item."""
+    checked = [i for i, item in enumerate(pending) if item[2]]
+    if not checked:
+        return previous
+
+    errors = _check_items([pending[i] for i in checked], previous)
+    for i, error in zip(checked, errors):
+        pending[i][3] = error
+
+    if refine:
+        lo = -1
+        lo_item = previous
+        for hi in checked:
+            if lo_item is not None and (lo_item[3] is None) != (pending[hi][3] is None):
+                _bisect_pending(pending, lo, hi, lo_item, lo_item[3] is None)
+                if isinstance(pending[hi][3], check_frame.SceneChangeException):
+                    _recheck_scene(pending, lo, hi)
+            lo = hi
+            lo_item = pending[hi]
+
+    return pending[checked[-1]]
+
+
+def _check_items(items, previous=None, track=True):
+    # check_frame.check_batch of items against the previous item, by frame index
+    return check_frame.check_batch(
+        [item[1] for item in items], previous[1] if previous is not None else None,
+        indices=[item[0] for item in items], previous_index=previous[0] if previous is not None else None,
+        track=track,
+    )
+
+
+def _bisect_pending(pending, lo, hi, lo_item, lo_correct):
+    """Checks frames between pending items lo (-1 for lo_item checked
+    before them) and hi with different results until the two neighbouring
+    ones where the result changes are found. Frames are checked against lo
+    while it is correct, otherwise against hi (it was correct after lo, so
+    they are one scene)."""
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        error = _check_items([pending[mid]], lo_item if lo_correct else pending[hi], track=False)[0]
+        pending[mid][2] = True
+        pending[mid][3] = error
+        if (error is None) == lo_correct:
+            lo = mid
+            lo_item = pending[mid]
+        else:
+            hi = mid
+
+
+def _recheck_scene(pending, lo, hi):
+    """Checks pending item hi, rejected as another scene than lo, against
+    the first frame of that scene found by _bisect_pending. When it is
+    correct there, frames between them are bisected again, they were
+    checked against the old scene too."""
+    cut = next((
+        i for i in range(lo + 1, hi)
+        if pending[i][2] and isinstance(pending[i][3], check_frame.SceneChangeException)
+    ), None)
+    if cut is None:
+        return
+    pending[hi][3] = _check_items([pending[hi]], pending[cut], track=False)[0]
+    if pending[hi][3] is not None:
+        return
+    for item in pending[cut + 1:hi]:
+        item[2], item[3] = False, None
+    _bisect_pending(pending, cut, hi, pending[cut], False)
+
+
 def safe_run(r):
     t = threading.Thread(target=r)
     t.start()
@@ -190,6 +1002,19 @@ def finalize_video(
         video_writer, video_part_file, audio_file, frames_written,
         video_part_start, frame_idx, fps, final_file, fragments,
 ):
+    if _finalize_video_file(
+            video_writer, video_part_file, audio_file, frames_written,
+            video_part_start, frame_idx, fps, final_file,
+    ):
+        return count_fragment(fragments)
+    return fragments
+
+
+def _finalize_video_file(
+        video_writer, video_part_file, audio_file, frames_written,
+        video_part_start, frame_idx, fps, final_file,
+):
+    # finalize_video without counting, returns whether the fragment is stored
     logging.info("Finish video fragment {}: {}-{}, frames written {}".format(
         video_part_file, video_part_start, frame_idx, frames_written))
     safe_run(video_writer.release)
@@ -204,11 +1029,23 @@ def finalize_video(
         except audio.ApplyAudioException as e:
             os.remove(video_part_file)
             logging.error("Join with audio error: %s, file %s removed" % (str(e), video_part_file))
-            return fragments
+            return False
+
+    move_fragment(video_part_file, final_file)
+    return True
+
 
+def store_fragment(video_part_file, final_file, fragments):
+    move_fragment(video_part_file, final_file)
+    return count_fragment(fragments)
+
+
+def move_fragment(video_part_file, final_file):
     shutil.move(video_part_file, final_file)
     logging.info("File stored to %s" % final_file)
 
+
+def count_fragment(fragments):
     fragments += 1
     mlboard.update_task_info({
         "process.fragments": fragments,
@@ -0,0 +1,68 @@
+import collections
+
+import cv2
+from skimage.metrics import structural_similarity
+
+SSIM = 'ssim'
+# Bhattacharyya distance of hue-saturation histograms
+HIST = 'hist'
+# mean absolute difference of grayscale images
+ABSDIFF = 'absdiff'
+
+METRICS = (SSIM, HIST, ABSDIFF)
+
+
+class SceneChangeDetector(object):
+    """Scores how much a frame differs from the previous one, from 0 for
+    the same frames to 1. Frames are compared downscaled to size, they are
+    to be given resized from the source frames one way (check_frame gives
+    face detector inputs), so a pair scores the same whoever compares it.
+    Downscaled frames of the last cache_size keys are cached."""
+
+    def __init__(self, metric=SSIM, size=(100, 100), cache_size=8):
+        if metric not in METRICS:
+            raise ValueError("unknown scene change metric %s" % metric)
+        self.metric = metric
+        self.size = size
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    def _downscale(self, image):
+        small = cv2.resize(image, self.size, interpolation=cv2.INTER_AREA)
+        if self.metric == HIST:
+            hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+            hist = cv2.calcHist([hsv], [0, 1], None, [30, 32], [0, 180, 0, 256])
+            return cv2.normalize(hist, hist)
+        if self.metric == ABSDIFF:
+            return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small
+
+    def _compare(self, a, b):
+        if self.metric == HIST:
+            return cv2.compareHist(a, b, cv2.HISTCMP_BHATTACHARYYA)
+        if self.metric == ABSDIFF:
+            return cv2.norm(a, b, cv2.NORM_L1) / (a.size * 255.)
+        return 1 - structural_similarity(a, b, channel_axis=-1)
+
+    def cached(self, key):
+        return key is not None and key in self._cache
+
+    def _small_of(self, image, key):
+        if self.cached(key):
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        small = self._downscale(image)
+        if key is not None:
+            self._cache[key] = small
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return small
+
+    def difference(self, image, previous, key=None, previous_key=None):
+        """Returns the difference of image from previous, None if there is
+        no previous. key and previous_key (e.g. frame indices) identify them
+        in the cache, None is not cached; a cached previous is not used."""
+        current = self._small_of(image, key)
+        if previous is None:
+            return None
+        return self._compare(current, self._small_of(previous, previous_key))
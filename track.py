@@ -0,0 +1,103 @@
+import numpy as np
+
+import detect
+
+
+def _iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0., x2 - x1) * max(0., y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.
+
+
+class FaceTracker(object):
+    """Detects faces on resize_for_detector images of consecutive checked
+    frames, running the full detector only on each full_every frame.
+
+    Between full detections the last single face is verified on a region
+    around it (roi_scale times the face, resized to roi_size): the frame
+    keeps it as its only face if exactly one face is found there with IoU
+    of at least iou_threshold. Otherwise the full detector runs on it and
+    on the rest of the batch. Faces outside the region are not seen until
+    the next full detection. last_index is left to the caller to mark the
+    frame the state is of, reset() clears it.
+    """
+
+    def __init__(self, full_every=10, iou_threshold=.5, roi_scale=2., roi_size=128):
+        self.full_every = full_every
+        self.iou_threshold = iou_threshold
+        self.roi_scale = roi_scale
+        self.roi_size = roi_size
+        self.reset()
+
+    def reset(self):
+        self._box = None
+        self._since_full = 0
+        self.last_index = None
+
+    def _roi(self, image):
+        h, w = image.shape[:2]
+        x1, y1, x2, y2 = self._box[:4]
+        half = max(x2 - x1, y2 - y1) * self.roi_scale / 2
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        rx1, ry1 = int(max(0, cx - half)), int(max(0, cy - half))
+        rx2, ry2 = int(min(w, cx + half)), int(min(h, cy + half))
+        if rx2 - rx1 < 2 or ry2 - ry1 < 2:
+            return None
+        return rx1, ry1, rx2, ry2
+
+    def _verify(self, images, threshold):
+        rois = [self._roi(image) for image in images]
+        if any(roi is None for roi in rois):
+            return [None] * len(images)
+        crops = [
+            detect.resize_for_detector(image[ry1:ry2, rx1:rx2], width=self.roi_size, height=self.roi_size)
+            for image, (rx1, ry1, rx2, ry2) in zip(images, rois)
+        ]
+        faces = detect.detect_faces_batch(crops, threshold=threshold, resized=True)
+
+        boxes = []
+        for (rx1, ry1, rx2, ry2), roi_faces in zip(rois, faces):
+            if len(roi_faces) != 1:
+                boxes.append(None)
+                continue
+            box = np.array(roi_faces[0], dtype=np.float64)
+            box[[0, 2]] = box[[0, 2]] * (rx2 - rx1) / self.roi_size + rx1
+            box[[1, 3]] = box[[1, 3]] * (ry2 - ry1) / self.roi_size + ry1
+            boxes.append(box if _iou(box, self._box) >= self.iou_threshold else None)
+        return boxes
+
+    def detect_batch(self, images, threshold=.5, fresh=None):
+        """Returns faces for each image as detect.detect_faces_batch does.
+        fresh marks images not following the previous one (e.g. after a
+        rejected scene change), the full detector runs on them."""
+        results = [None] * len(images)
+
+        roi = []
+        if self._box is not None:
+            for i in range(len(images)):
+                if self._since_full + len(roi) + 1 >= self.full_every or fresh and fresh[i]:
+                    break
+                roi.append(i)
+        if roi:
+            for i, box in zip(roi, self._verify([images[i] for i in roi], threshold)):
+                if box is None:
+                    break
+                results[i] = [box]
+
+        full = [i for i, faces in enumerate(results) if faces is None]
+        if full:
+            faces = detect.detect_faces_batch([images[i] for i in full], threshold=threshold, resized=True)
+            for i, image_faces in zip(full, faces):
+                results[i] = image_faces
+
+        full = set(full)
+        for i, faces in enumerate(results):
+            if i in full:
+                self._since_full = 0
+            else:
+                self._since_full += 1
+            self._box = faces[0] if len(faces) == 1 else None
+
+        return results
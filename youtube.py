@@ -1,13 +1,34 @@
+import collections
 import logging
+import os
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from pytube import YouTube, exceptions
+from pytube import YouTube, exceptions, extract
 
 
 class YouTubeDownloadException(Exception):
     pass
 
 
+def video_id(link):
+    """Returns the YouTube video id of link, link itself if it has none."""
+    try:
+        return extract.video_id(link)
+    except exceptions.RegexMatchError:
+        return link
+
+
+def unique_links(links):
+    """Returns links without repeated ones and ones to a video linked
+    before: their downloads are named by the video id and would collide."""
+    unique = collections.OrderedDict()
+    for link in links:
+        unique.setdefault(video_id(link), link)
+    return list(unique.values())
+
+
 def download(link, temp_dir=None) -> (str, str):
     if temp_dir is None:
         temp_dir = tempfile.gettempdir()
@@ -52,3 +73,68 @@ def download(link, temp_dir=None) -> (str, str):
         audio_file = video_file
 
     return video_file, audio_file
+
+
+class Prefetcher(object):
+    """Downloads links in background threads ahead of their processing.
+
+    Iterating yields (link, video_file, audio_file, error) in link order,
+    error is a failed download exception and the files are None then.
+    release() must be called for each downloaded link once its files are
+    removed. Links must be to different videos (see unique_links). Downloads
+    start while less than lookahead + consumers links are downloading or
+    not released and, if max_bytes is set, their files take less than
+    max_bytes (one link is always downloaded if nothing else is).
+    """
+
+    def __init__(self, links, lookahead=1, consumers=1, max_bytes=None, temp_dir=None):
+        self.links = links
+        self.lookahead = lookahead
+        self.consumers = consumers
+        self.max_bytes = max_bytes
+        self.temp_dir = temp_dir
+        self._cond = threading.Condition()
+        self._sizes = {}
+        self._bytes = 0
+        self._in_use = 0
+
+    def _download(self, link):
+        try:
+            video_file, audio_file = download(link, self.temp_dir)
+        except (YouTubeDownloadException, exceptions.PytubeError) as e:
+            return link, None, None, e
+        size = sum(os.path.getsize(f) for f in {video_file, audio_file})
+        with self._cond:
+            self._sizes[video_file] = size
+            self._bytes += size
+        return link, video_file, audio_file, None
+
+    def _can_start(self, pending):
+        if pending + self._in_use >= self.lookahead + self.consumers:
+            return False
+        return self.max_bytes is None or self._bytes < self.max_bytes or pending + self._in_use == 0
+
+    def __iter__(self):
+        links = collections.deque(self.links)
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.lookahead + self.consumers) as pool:
+            while links or pending:
+                with self._cond:
+                    while links:
+                        if self._can_start(len(pending)):
+                            pending.append(pool.submit(self._download, links.popleft()))
+                        elif pending:
+                            break
+                        else:
+                            self._cond.wait()
+                result = pending.popleft().result()
+                if result[3] is None:
+                    with self._cond:
+                        self._in_use += 1
+                yield result
+
+    def release(self, video_file):
+        with self._cond:
+            self._bytes -= self._sizes.pop(video_file, 0)
+            self._in_use -= 1
+            self._cond.notify_all()